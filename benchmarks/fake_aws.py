@@ -0,0 +1,253 @@
+"""In-memory stand-in for the AWS APIs used by the deletion scripts.
+
+Like botocore's Stubber, the stand-in answers calls from a before-call
+hook, so requests go through the real clients, paginators and the
+tool's own event hooks but never reach the network. Unlike Stubber it
+keeps state: listings page through a synthetic account, deletes remove
+resources, and any number of threads can call it in any order.
+"""
+import bisect
+import threading
+from collections import Counter
+
+import botocore.session
+from botocore.awsrequest import AWSResponse
+
+
+ACCOUNT_ID = '123456789012'
+REGION = 'us-east-1'
+PREFIX = 'bench'
+# Resources that do not match the prefix, per 10 that do.
+UNMATCHED_PER_10 = 1
+
+# Page size used when a call does not ask for one, per service.
+PAGE_SIZES = {'ec2': 1000, 'lambda': 50, 's3': 10000}
+DEFAULT_PAGE_SIZE = 100
+
+
+def _arn(service, resource):
+    return f"arn:aws:{service}:{REGION}:{ACCOUNT_ID}:{resource}"
+
+
+def _name_tag(name):
+    return [{'Key': 'Name', 'Value': name}]
+
+
+# Flag -> (service, list operation, result key, ID field or None when the
+# item is its own ID, make(index, name) -> item, delete operation, delete
+# parameter). EC2 instances are listed inside one reservation each.
+RESOURCES = {
+    'ecs': ('ecs', 'ListClusters', 'clusterArns', None,
+            lambda i, name: _arn('ecs', f"cluster/{name}"),
+            'DeleteCluster', 'cluster'),
+    'lambda': ('lambda', 'ListFunctions', 'Functions', 'FunctionName',
+               lambda i, name: {'FunctionName': name},
+               'DeleteFunction', 'FunctionName'),
+    'step': ('stepfunctions', 'ListStateMachines', 'stateMachines', 'stateMachineArn',
+             lambda i, name: {'stateMachineArn': _arn('states', f"stateMachine:{name}"),
+                              'name': name},
+             'DeleteStateMachine', 'stateMachineArn'),
+    'sns': ('sns', 'ListTopics', 'Topics', 'TopicArn',
+            lambda i, name: {'TopicArn': _arn('sns', name)},
+            'DeleteTopic', 'TopicArn'),
+    'amplify': ('amplify', 'ListApps', 'apps', 'appId',
+                lambda i, name: {'appId': f"d{i:012d}", 'name': name},
+                'DeleteApp', 'appId'),
+    'ecr': ('ecr', 'DescribeRepositories', 'repositories', 'repositoryName',
+            lambda i, name: {'repositoryName': name},
+            'DeleteRepository', 'repositoryName'),
+    'elbv2': ('elbv2', 'DescribeLoadBalancers', 'LoadBalancers', 'LoadBalancerArn',
+              lambda i, name: {'LoadBalancerArn': _arn(
+                  'elasticloadbalancing', f"loadbalancer/app/{name}/{i:016x}")},
+              'DeleteLoadBalancer', 'LoadBalancerArn'),
+    'tg': ('elbv2', 'DescribeTargetGroups', 'TargetGroups', 'TargetGroupArn',
+           lambda i, name: {'TargetGroupArn': _arn(
+               'elasticloadbalancing', f"targetgroup/{name}/{i:016x}")},
+           'DeleteTargetGroup', 'TargetGroupArn'),
+    'ec2': ('ec2', 'DescribeInstances', 'Reservations', 'InstanceId',
+            lambda i, name: {'InstanceId': f"i-{i:017x}", 'Tags': _name_tag(name),
+                             'State': {'Name': 'running'}},
+            'TerminateInstances', 'InstanceIds'),
+    'elasticache': ('elasticache', 'DescribeCacheClusters', 'CacheClusters', 'CacheClusterId',
+                    lambda i, name: {'CacheClusterId': name},
+                    'DeleteCacheCluster', 'CacheClusterId'),
+    'rds': ('rds', 'DescribeDBInstances', 'DBInstances', 'DBInstanceIdentifier',
+            lambda i, name: {'DBInstanceIdentifier': name},
+            'DeleteDBInstance', 'DBInstanceIdentifier'),
+    'redshift': ('redshift', 'DescribeClusters', 'Clusters', 'ClusterIdentifier',
+                 lambda i, name: {'ClusterIdentifier': name},
+                 'DeleteCluster', 'ClusterIdentifier'),
+    's3': ('s3', 'ListBuckets', 'Buckets', 'Name',
+           lambda i, name: {'Name': name, 'BucketRegion': REGION},
+           'DeleteBucket', 'Bucket'),
+    'sg': ('ec2', 'DescribeSecurityGroups', 'SecurityGroups', 'GroupId',
+           lambda i, name: {'GroupId': f"sg-{i:017x}", 'GroupName': name},
+           'DeleteSecurityGroup', 'GroupId'),
+    'vpc': ('ec2', 'DescribeVpcs', 'Vpcs', 'VpcId',
+            lambda i, name: {'VpcId': f"vpc-{i:017x}", 'Tags': _name_tag(name)},
+            'DeleteVpc', 'VpcId'),
+}
+
+# Calls answered with a fixed response.
+STATIC_RESPONSES = {
+    ('sts', 'GetCallerIdentity'): {'Account': ACCOUNT_ID},
+}
+
+
+class _Store:
+    """One resource type, paged by ID so deletes never shift later pages."""
+
+    def __init__(self, items, id_field):
+        self.id_field = id_field
+        self.items = {self.id_of(item): item for item in items}
+        self.ids = sorted(self.items)
+        self.lock = threading.Lock()
+
+    def id_of(self, item):
+        return item if self.id_field is None else item[self.id_field]
+
+    def page(self, after, size, keep):
+        with self.lock:
+            start = bisect.bisect_right(self.ids, after) if after else 0
+            page, last = [], None
+            for index in range(start, len(self.ids)):
+                resource_id = self.ids[index]
+                item = self.items.get(resource_id)
+                if item is None or not keep(item):
+                    continue
+                if len(page) == size:
+                    return page, last
+                page.append(item)
+                last = resource_id
+        return page, None
+
+    def remove(self, resource_id):
+        with self.lock:
+            return self.items.pop(resource_id, None) is not None
+
+    def __len__(self):
+        return len(self.items)
+
+
+def _filter_matches(item, flt):
+    name, values = flt['Name'], flt['Values']
+    if name == 'instance-state-name':
+        return item.get('State', {}).get('Name') in values
+    if name == 'group-name':
+        candidates = [item.get('GroupName', '')]
+    elif name.startswith('tag:'):
+        candidates = [tag['Value'] for tag in item.get('Tags', [])
+                      if tag['Key'] == name[4:]]
+    else:
+        return False
+    for value in values:
+        for candidate in candidates:
+            if value.endswith('*') and candidate.startswith(value[:-1]):
+                return True
+            if candidate == value:
+                return True
+    return False
+
+
+class FakeAccount:
+    """A synthetic account with size matching resources for each flag."""
+
+    def __init__(self, size, flags=RESOURCES):
+        self.size = size
+        self.calls = Counter()
+        self._calls_lock = threading.Lock()
+        self._stores = {}
+        self._deletes = {}
+        self._paginators = {}
+        self.unmatched = unmatched = size * UNMATCHED_PER_10 // 10
+        for flag in flags:
+            service, list_op, _, id_field, make, delete_op, _ = RESOURCES[flag]
+            items = [make(i, f"{PREFIX}-{flag}-{i}") for i in range(size)]
+            items += [make(size + i, f"other-{flag}-{i}") for i in range(unmatched)]
+            store = _Store(items, id_field)
+            self._stores[(service, list_op)] = (flag, store)
+            self._deletes[(service, delete_op)] = (flag, store)
+
+    @property
+    def resource_count(self):
+        return self.size * len(self._stores)
+
+    def remaining(self):
+        return {flag: len(store) for flag, store in self._stores.values()}
+
+    def register(self, events):
+        """Answer every client created from a session with these events."""
+        events.register_first('before-parameter-build', self._capture_params)
+        events.register_first('before-call', self._handle)
+
+    @staticmethod
+    def _capture_params(params, context, **kwargs):
+        context['fake_aws_params'] = dict(params)
+
+    def _paginator(self, service, operation):
+        key = (service, operation)
+        if key not in self._paginators:
+            try:
+                self._paginators[key] = botocore.session.get_session() \
+                    .get_paginator_model(service).get_paginator(operation)
+            except Exception:
+                self._paginators[key] = None
+        return self._paginators[key]
+
+    def _handle(self, model, context, **kwargs):
+        service = model.service_model.service_name
+        operation = model.name
+        params = context.get('fake_aws_params', {})
+        with self._calls_lock:
+            self.calls[f"{service}.{operation}"] += 1
+
+        key = (service, operation)
+        if key in STATIC_RESPONSES:
+            return _response(dict(STATIC_RESPONSES[key]))
+        if key in self._stores:
+            return _response(self._list(service, operation, params))
+        if key in self._deletes:
+            return self._delete(service, operation, params)
+        # Everything else (VPC children, object listings, bucket emptying)
+        # finds nothing and succeeds.
+        return _response({})
+
+    def _list(self, service, operation, params):
+        flag, store = self._stores[(service, operation)]
+        result_key = RESOURCES[flag][2]
+        paginator = self._paginator(service, operation)
+        size = PAGE_SIZES.get(service, DEFAULT_PAGE_SIZE)
+        after = None
+        if paginator is not None:
+            size = params.get(paginator.get('limit_key'), size)
+            after = params.get(paginator['input_token'])
+        filters = params.get('Filters', [])
+        page, last = store.page(
+            after, size, lambda item: all(_filter_matches(item, f) for f in filters))
+        if flag == 'ec2':
+            page = [{'Instances': [item]} for item in page]
+        parsed = {result_key: page}
+        if last is not None and paginator is not None:
+            parsed[paginator['output_token']] = last
+        return parsed
+
+    def _delete(self, service, operation, params):
+        flag, store = self._deletes[(service, operation)]
+        param = RESOURCES[flag][6]
+        if flag == 'ec2':
+            terminating = []
+            for instance_id in params[param]:
+                store.remove(instance_id)
+                terminating.append({'InstanceId': instance_id,
+                                    'PreviousState': {'Name': 'running'},
+                                    'CurrentState': {'Name': 'shutting-down'}})
+            return _response({'TerminatingInstances': terminating})
+        if not store.remove(params[param]):
+            return _response({'Error': {'Code': 'ResourceNotFoundException',
+                                        'Message': f"{params[param]} not found"}}, 400)
+        return _response({})
+
+
+def _response(parsed, status_code=200):
+    parsed.setdefault('ResponseMetadata', {'HTTPStatusCode': status_code})
+    return AWSResponse(None, status_code, {}, None), parsed
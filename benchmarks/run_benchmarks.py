@@ -0,0 +1,191 @@
+"""Benchmark the deletion scripts against synthetic accounts.
+
+Every scenario (script, mode and resources per service) runs in its own
+Python process against the in-memory stand-in from fake_aws, with all 15
+services selected. Reported per scenario: wall time of main(), API calls
+made, calls per matching resource and peak resident memory.
+
+    python benchmarks/run_benchmarks.py --sizes 100 1000 10000 --out results.json
+    python benchmarks/run_benchmarks.py --baseline results.json
+
+With --baseline, the run is compared against saved results and exits
+non-zero if any scenario makes more API calls, or takes more time or
+memory than the baseline allows for with --tolerance.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(os.path.dirname(HERE), 'src')
+
+SCRIPTS = {
+    'services': 'delete_services',
+    'compact': 'delete_compact',
+}
+MODES = ['plan', 'execute']
+DEFAULT_SIZES = [100, 1000, 10000]
+DEFAULT_TOLERANCE = 0.25
+
+
+def _scenario_key(scenario):
+    return f"{scenario['script']}/{scenario['mode']}/{scenario['size']}"
+
+
+def run_scenario(scenario):
+    """Run one scenario in this process and return its measurements."""
+    sys.path[:0] = [SRC, HERE]
+    os.environ.update(AWS_ACCESS_KEY_ID='bench', AWS_SECRET_ACCESS_KEY='bench',
+                      AWS_DEFAULT_REGION='us-east-1')
+    os.environ.pop('AWS_PROFILE', None)
+
+    import boto3
+    import aws_clients
+    from fake_aws import PREFIX, REGION, RESOURCES, FakeAccount
+
+    module = __import__(SCRIPTS[scenario['script']])
+    account = FakeAccount(scenario['size'])
+    session = boto3.session.Session(region_name=REGION)
+    account.register(session.events)
+    # Every client the scripts build comes from this session.
+    aws_clients._sessions[None] = session
+
+    argv = [module.__name__, '--prefix', PREFIX, '--no-cache']
+    argv += [f'--{flag}' for flag in RESOURCES]
+    if scenario['mode'] == 'execute':
+        argv.append('--execute')
+    sys.argv = argv
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    module.main()
+    wall_time = time.perf_counter() - started
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    api_calls = sum(account.calls.values())
+    left = sum(account.remaining().values())
+    expected_left = len(RESOURCES) * account.unmatched
+    if scenario['mode'] == 'plan':
+        expected_left += account.resource_count
+    return {
+        **scenario,
+        'resources': account.resource_count,
+        'wall_time': round(wall_time, 3),
+        'api_calls': api_calls,
+        'calls_per_resource': round(api_calls / account.resource_count, 4),
+        'peak_rss_mb': round(rss_peak / 1024, 1),
+        'rss_growth_mb': round((rss_peak - rss_before) / 1024, 1),
+        'complete': left == expected_left,
+        'calls': dict(sorted(account.calls.items())),
+    }
+
+
+def _spawn(scenario):
+    # Logs go to a scratch directory and are discarded; execute mode
+    # writes a log file into the working directory.
+    with tempfile.TemporaryDirectory() as workdir:
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--scenario', json.dumps(scenario)],
+            cwd=workdir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def _print_table(results, baseline):
+    header = (f"{'scenario':<26}{'resources':>10}{'wall s':>10}{'calls':>9}"
+              f"{'calls/res':>11}{'peak MB':>9}")
+    if baseline:
+        header += f"{'wall vs base':>14}{'calls vs base':>15}"
+    print(header)
+    for result in results:
+        key = _scenario_key(result)
+        line = (f"{key:<26}{result['resources']:>10}{result['wall_time']:>10.2f}"
+                f"{result['api_calls']:>9}{result['calls_per_resource']:>11.3f}"
+                f"{result['peak_rss_mb']:>9.1f}")
+        base = baseline.get(key)
+        if base:
+            line += (f"{_change(result['wall_time'], base['wall_time']):>14}"
+                     f"{_change(result['api_calls'], base['api_calls']):>15}")
+        if not result['complete']:
+            line += "  INCOMPLETE"
+        print(line)
+
+
+def _change(current, base):
+    if not base:
+        return 'n/a'
+    return f"{(current - base) / base:+.1%}"
+
+
+def _regressions(results, baseline, tolerance):
+    problems = []
+    for result in results:
+        key = _scenario_key(result)
+        if not result['complete']:
+            problems.append(f"{key}: not every matching resource was handled")
+        base = baseline.get(key)
+        if not base:
+            continue
+        if result['api_calls'] > base['api_calls']:
+            problems.append(
+                f"{key}: {result['api_calls']} API calls, baseline {base['api_calls']}")
+        for metric in ('wall_time', 'peak_rss_mb'):
+            if result[metric] > base[metric] * (1 + tolerance):
+                problems.append(
+                    f"{key}: {metric} {result[metric]}, baseline {base[metric]}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the deletion scripts against synthetic accounts.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help=f"Matching resources per service, e.g. 100 50000. Default is {DEFAULT_SIZES}.")
+    parser.add_argument('--scripts', nargs='+', choices=list(SCRIPTS), default=list(SCRIPTS),
+                        help="Scripts to benchmark. Default is both.")
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES,
+                        help="Modes to benchmark. Default is both.")
+    parser.add_argument('--out', help="Save the results to this JSON file.")
+    parser.add_argument('--baseline', help="Compare against results saved with --out.")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help=f"Allowed relative increase in wall time and memory over the baseline. Default is {DEFAULT_TOLERANCE}.")
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        print(json.dumps(run_scenario(json.loads(args.scenario))))
+        return
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {_scenario_key(r): r for r in json.load(f)['results']}
+
+    results = []
+    for size in args.sizes:
+        for script in args.scripts:
+            for mode in args.modes:
+                scenario = {'script': script, 'mode': mode, 'size': size}
+                print(f"Running {_scenario_key(scenario)}...", file=sys.stderr)
+                results.append(_spawn(scenario))
+
+    _print_table(results, baseline)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'created_at': time.time(), 'python': sys.version.split()[0],
+                       'results': results}, f, indent=2)
+
+    problems = _regressions(results, baseline, args.tolerance)
+    for problem in problems:
+        print(f"REGRESSION {problem}", file=sys.stderr)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import logging
+import multiprocessing
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from aws_clients import ClientSet
+
+
+DEFAULT_ROLE_NAME = 'OrganizationAccountAccessRole'
+DEFAULT_ACCOUNT_WORKERS = 8
+
+_ACCOUNT_ID = re.compile(r'^\d{12}$')
+_ROLE_ARN = re.compile(r'^arn:aws[\w-]*:iam::(\d{12}):role/\S+$')
+
+
+class AccountLogger(logging.LoggerAdapter):
+    """Prefixes every message with the account it belongs to and adds the
+    account to the record's structured fields."""
+
+    def process(self, msg, kwargs):
+        kwargs['extra'] = {**self.extra, **kwargs.get('extra', {})}
+        return f"[{self.extra['account']}] {msg}", kwargs
+
+
+def resolve_accounts(account_args, role_name=DEFAULT_ROLE_NAME):
+    """Turn --accounts values into a list of role ARNs to assume.
+
+    Values may be space or comma separated, and are either role ARNs or
+    account IDs, which stand for role_name in that account. Raises
+    ValueError for anything else.
+    """
+    role_arns = []
+    for value in account_args:
+        for item in (name.strip() for name in value.split(',')):
+            if not item:
+                continue
+            if _ACCOUNT_ID.match(item):
+                role_arns.append(f"arn:aws:iam::{item}:role/{role_name}")
+            elif _ROLE_ARN.match(item):
+                role_arns.append(item)
+            else:
+                raise ValueError(f"'{item}' is neither an account ID nor a role ARN")
+    return list(dict.fromkeys(role_arns))
+
+
+def account_of(role_arn):
+    return _ROLE_ARN.match(role_arn).group(1)
+
+
+def assume_role(role_arn):
+    """Return credentials for role_arn in the form ClientSet takes.
+
+    Clients built with them assume the role with the default credentials
+    and assume it again before each session expires, so an account's run
+    is not cut off after the role's session duration. The role is assumed
+    once here, so an account whose role cannot be assumed fails before
+    any of its work starts.
+    """
+    ClientSet(credentials=role_arn).sts.get_caller_identity()
+    return role_arn
+
+
+def run_in_accounts(role_arns, func, workers=DEFAULT_ACCOUNT_WORKERS,
+                    initializer=None, initargs=()):
+    """Call func(role_arn) for every account in a pool of processes.
+
+    Each account runs in a process of its own, so its clients, rate
+    limiters and worker pools are separate from every other account's and
+    the run takes as long as its slowest account. func must be a module
+    level function; processes are spawned rather than forked, so they
+    start from a clean import and call initializer(*initargs) first.
+    Yields (role_arn, result, error) tuples in the order of role_arns,
+    with error set to the exception func raised, or None.
+    """
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=min(workers, len(role_arns)),
+                             mp_context=context, initializer=initializer,
+                             initargs=initargs) as pool:
+        futures = [(role_arn, pool.submit(func, role_arn)) for role_arn in role_arns]
+        for role_arn, future in futures:
+            error = future.exception()
+            yield role_arn, None if error else future.result(), error
@@ -1,15 +1,173 @@
+import threading
+
 import boto3
+import botocore.session
+from botocore.config import Config
+from botocore.credentials import AssumeRoleCredentialFetcher, DeferredRefreshableCredentials
+
+import deadline
+import metrics
+import rate_limit
+
+
+# Attribute name on ClientSet -> boto3 service name.
+SERVICES = {
+    'rds': 'rds',
+    'ec2': 'ec2',
+    'ecs': 'ecs',
+    'redshift': 'redshift',
+    'elasticache': 'elasticache',
+    'elbv2': 'elbv2',
+    'ecr': 'ecr',
+    'amplify': 'amplify',
+    'secrets_manager': 'secretsmanager',
+    'sns': 'sns',
+    'sfn': 'stepfunctions',
+    'lambda_client': 'lambda',
+    's3': 's3',
+    'sts': 'sts',
+    'tagging': 'resourcegroupstaggingapi',
+}
+
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+# botocore retries throttled and transient failures with backoff; the
+# rate limiter attached to each client keeps those retries rare.
+DEFAULT_MAX_ATTEMPTS = 10
+# Seconds per attempt to connect and to wait for a response. botocore
+# waits 60 seconds to connect; an endpoint that does not answer in 10
+# is better retried.
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+ROLE_SESSION_NAME = 'aws-service-deleter'
+
+_lock = threading.Lock()
+_sessions = {}
+_clients = {}
+_config = Config(
+    max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS,
+    retries={'mode': 'standard', 'max_attempts': DEFAULT_MAX_ATTEMPTS},
+    connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+    read_timeout=DEFAULT_READ_TIMEOUT,
+)
+
+
+def configure(max_pool_connections=None, connect_timeout=None, read_timeout=None):
+    """Set the botocore Config shared by every client created from now on.
+
+    Call this before the first client is requested; clients that already
+    exist keep the config they were built with. Settings left as None
+    keep their current value.
+    """
+    global _config
+    settings = {name: value for name, value in (
+        ('max_pool_connections', max_pool_connections),
+        ('connect_timeout', connect_timeout),
+        ('read_timeout', read_timeout),
+    ) if value is not None}
+    if settings:
+        with _lock:
+            _config = _config.merge(Config(**settings))
+
+
+def _get_session(credentials):
+    # Callers hold _lock. One session per set of credentials means each
+    # service model is loaded once per run, not once per client.
+    session = _sessions.get(credentials)
+    if session is None:
+        if credentials is None:
+            session = boto3.session.Session()
+        else:
+            session = _assumed_role_session(_get_session(None), credentials)
+        _sessions[credentials] = session
+    return session
+
+
+def _assumed_role_session(source, role_arn):
+    # The source session's credentials assume the role on first use and
+    # again shortly before each set expires, so clients keep working past
+    # the role's session duration.
+    fetcher = AssumeRoleCredentialFetcher(
+        client_creator=source._session.create_client,
+        source_credentials=source._session.get_credentials(),
+        role_arn=role_arn,
+        extra_args={'RoleSessionName': ROLE_SESSION_NAME})
+    botocore_session = botocore.session.Session()
+    botocore_session._credentials = DeferredRefreshableCredentials(
+        method='assume-role', refresh_using=fetcher.fetch_credentials)
+    return boto3.session.Session(botocore_session=botocore_session,
+                                 region_name=source.region_name)
+
+
+def default_region():
+    with _lock:
+        return _get_session(None).region_name
+
+
+def get_client(service, region=None, credentials=None):
+    """Return the shared client for a service, region and credentials.
+
+    Clients are created on first use and reused afterwards. boto3 clients
+    are thread-safe once built; creation goes through a lock because
+    sessions are not. Each new client gets the rate limiter and circuit
+    breaker of its service and region attached, records its calls in
+    metrics and sends nothing after the run's deadline. credentials is
+    None for the default provider chain or the ARN of a role the default
+    credentials assume.
+    """
+    key = (service, region, credentials)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _get_session(credentials).client(
+                    service, region_name=region, config=_config)
+                # First, so requests refused at the deadline do not
+                # wait for a rate limiter token.
+                deadline.attach(client)
+                rate_limit.attach(client, credentials)
+                metrics.attach(client)
+                _clients[key] = client
+    return client
+
+
+class ClientSet:
+    """Lazy access to one client per supported service in one region.
+
+    region=None uses the default region of the active profile. Clients
+    come from the shared registry, so two sets for the same region and
+    credentials hand out the same client objects.
+    """
+
+    def __init__(self, region=None, credentials=None):
+        self._region = region
+        self._account_id = None
+        self.credentials = credentials
+
+    @property
+    def region(self):
+        if self._region is None:
+            self._region = default_region()
+        return self._region
+
+    @property
+    def account_id(self):
+        if self._account_id is None:
+            self._account_id = self.sts.get_caller_identity()['Account']
+        return self._account_id
+
+    def __getattr__(self, name):
+        if name not in SERVICES:
+            raise AttributeError(name)
+        return get_client(SERVICES[name], self.region, self.credentials)
+
+
+DEFAULT_CLIENTS = ClientSet()
+
 
-rds = boto3.client('rds')
-ec2 = boto3.client('ec2')
-ecs = boto3.client('ecs')
-redshift = boto3.client('redshift')
-elasticache = boto3.client('elasticache')
-elbv2 = boto3.client('elbv2')
-ecr = boto3.client('ecr')
-amplify = boto3.client('amplify')
-secrets_manager = boto3.client('secretsmanager')
-sns = boto3.client('sns')
-sfn = boto3.client('stepfunctions')
-lambda_client = boto3.client('lambda')
-s3 = boto3.client('s3')
+def __getattr__(name):
+    # Keeps `from aws_clients import ec2` working without building clients
+    # at import time.
+    if name in SERVICES:
+        return getattr(DEFAULT_CLIENTS, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
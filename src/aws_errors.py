@@ -0,0 +1,29 @@
+from botocore.exceptions import ClientError
+
+
+# Error codes meaning the resource no longer exists. Deleting something
+# that is already gone counts as done, which lets runs work from cached or
+# saved resource lists without re-checking every item first.
+NOT_FOUND_ERRORS = {
+    'ResourceNotFoundException', 'NotFoundException', 'NotFound',
+    'ClusterNotFoundException', 'RepositoryNotFoundException',
+    'StateMachineDoesNotExist', 'LoadBalancerNotFound', 'TargetGroupNotFound',
+    'InvalidInstanceID.NotFound', 'CacheClusterNotFound', 'DBInstanceNotFound',
+    'DBInstanceNotFoundFault', 'ClusterNotFound', 'ClusterNotFoundFault',
+    'NoSuchBucket', 'InvalidGroup.NotFound', 'InvalidGroupId.NotFound',
+    'InvalidVpcID.NotFound', 'InvalidInternetGatewayID.NotFound',
+    'InvalidSubnetID.NotFound', 'InvalidRouteTableID.NotFound',
+    'InvalidNetworkInterfaceID.NotFound', 'NatGatewayNotFound',
+    'InvalidVpcEndpointId.NotFound',
+}
+
+
+def error_code(error):
+    """Return the AWS error code of an exception, or None."""
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code')
+    return None
+
+
+def is_not_found(error):
+    return error_code(error) in NOT_FOUND_ERRORS
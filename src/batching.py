@@ -0,0 +1,58 @@
+from itertools import islice
+
+from botocore.exceptions import ClientError
+
+from executor import run_in_pool
+
+
+# Delete APIs that accept a list of IDs, with the most IDs one call takes.
+BATCH_DELETE_LIMITS = {
+    "terminate_instances": 1000,
+}
+
+# Errors that apply to the whole request rather than to particular IDs, so
+# splitting the batch would only repeat the same failure.
+_REQUEST_LEVEL_ERRORS = {
+    "AccessDenied", "AccessDeniedException", "UnauthorizedOperation",
+    "AuthFailure", "ExpiredToken", "RequestExpired",
+    "Throttling", "ThrottlingException", "RequestLimitExceeded",
+}
+
+
+def chunked(items, size):
+    """Yield lists of at most size items, consuming items lazily."""
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def call_batch(call, batch):
+    """Call call(batch) and return a (resource_id, error) pair per ID.
+
+    When the call fails with an error that could be caused by a single bad
+    ID (not found, protected, wrong state), the batch is halved and each
+    half retried so the failing IDs are isolated and reported one by one
+    while the rest of the batch still goes through.
+    """
+    try:
+        call(batch)
+    except ClientError as e:
+        code = e.response.get('Error', {}).get('Code')
+        if len(batch) == 1 or code in _REQUEST_LEVEL_ERRORS:
+            return [(resource_id, e) for resource_id in batch]
+        middle = len(batch) // 2
+        return call_batch(call, batch[:middle]) + call_batch(call, batch[middle:])
+    except Exception as e:
+        return [(resource_id, e) for resource_id in batch]
+    return [(resource_id, None) for resource_id in batch]
+
+
+def run_batched(items, call, batch_size, workers=1):
+    """Coalesce items into batches of batch_size and run call on each.
+
+    Yields (resource_id, error) for every item in input order.
+    """
+    batches = chunked(items, batch_size)
+    for _, outcomes, _ in run_in_pool(
+            batches, lambda batch: call_batch(call, batch), workers):
+        yield from outcomes
@@ -0,0 +1,85 @@
+import time
+
+
+# Result error of a service the scheduler did not start.
+NOT_STARTED = "not started before the deadline"
+
+
+class DeadlineReached(Exception):
+    """Raised when work stops because the run's deadline is near.
+
+    A handler that stops part way raises it with what it got through:
+    found and failed as it would have returned them, and undone, the
+    resources it found but never deleted. Requests refused once the run
+    is over raise it with no counts.
+    """
+
+    def __init__(self, found=0, failed=0, undone=0):
+        message = "deadline reached"
+        if undone:
+            message += f", {undone} resource(s) left undone"
+        super().__init__(message)
+        self.found = found
+        self.failed = failed
+        self.undone = undone
+
+
+_settings = {'ends_at': None, 'stop_at': None}
+
+
+def reserve_for(budget, connect_timeout, read_timeout):
+    """Seconds to keep at the end of a budget for calls already sent: one
+    attempt's connect and read timeouts, but at most half the budget."""
+    return min(connect_timeout + read_timeout, budget / 2)
+
+
+def configure(ends_at=None, reserve=0.0):
+    """End the run at ends_at, a time.time() value, or never with None.
+
+    New work stops reserve seconds before ends_at, so the calls already
+    sent have that long to finish; after ends_at no request is sent at
+    all (see attach). Wall-clock time lets the processes a run starts
+    share its deadline.
+    """
+    _settings['ends_at'] = ends_at
+    _settings['stop_at'] = None if ends_at is None else ends_at - reserve
+
+
+def remaining():
+    """Seconds until new work stops, or None without a deadline."""
+    if _settings['stop_at'] is None:
+        return None
+    return max(0.0, _settings['stop_at'] - time.time())
+
+
+def expired():
+    """True once new work should no longer start."""
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def clamp(timeout):
+    """Return timeout, cut down to the time left for new work."""
+    left = remaining()
+    if left is None:
+        return timeout
+    return left if timeout is None else min(timeout, left)
+
+
+def check():
+    """Raise DeadlineReached once new work should no longer start. Called
+    first thing by queued work, so work queued before the deadline but
+    not started by then is cancelled."""
+    if expired():
+        raise DeadlineReached()
+
+
+def attach(client):
+    """Register a hook that refuses to send a client's requests, retries
+    included, once the run is over."""
+    def before_send(**kwargs):
+        ends_at = _settings['ends_at']
+        if ends_at is not None and time.time() >= ends_at:
+            raise DeadlineReached()
+
+    client.meta.events.register('before-send', before_send)
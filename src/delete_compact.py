@@ -1,107 +1,181 @@
-from aws_clients import (
-    rds, ec2, ecs, redshift,
-    elasticache, elbv2, ecr,
-    amplify, sns, sfn,
-    lambda_client, s3
-)
-from prefix_filter import get_resources_with_prefix
-from logging_config import logger
+from aws_clients import DEFAULT_CLIENTS, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT, configure
+from prefix_filter import PrefixMatcher, get_resources_with_prefix
+from aws_errors import is_not_found
+from deadline import NOT_STARTED, DeadlineReached
+import deadline
+import inventory_cache
+import profiling
+from logging_config import action_verb, get_logger
+from executor import run_in_pool
+from batching import BATCH_DELETE_LIMITS, run_batched
+from regions import client_sets_for, resolve_regions, run_in_regions
+from report import ServiceResult, log_report
+from s3_emptier import empty_bucket
+from scheduler import DEFAULT_SETTLE_TIMEOUT, run_scheduled
+from waiters import WaiterEngine
+from metrics import MetricsExporter
+import metrics
+from vpc_teardown import teardown_vpcs
 import argparse
+import logging
+import time
 
 
-METHODS_REQUIRING_LIST = {"terminate_instances", "delete_cache_cluster",
-                          "delete_db_instance", "delete_load_balancer", "delete_target_group"}
+logger = logging.getLogger('aws_service_deleter')
 
 
-def delete_resources(params, prefix, is_execute=False):
-    """Generalised function to delete resources or plan deletion using AWS clients."""
+def _cache_key(params):
+    return f"{params['service_type']}:{params['resource_key']}"
 
-    resources = get_resources_with_prefix(
-        params["client"], prefix, params["resource_key"], params["identifier_key"],
-        service_type=params["service_type"], method=params["method"]
-    )
 
-    if not resources:
-        logger.info(f"No {params['resource_name']
-                          }s found with prefix '{prefix}'")
-        return
+def discover(params, prefix, clients=DEFAULT_CLIENTS, use_cache=True):
+    """Yield the IDs of a service's resources matching prefix."""
+    def live():
+        return get_resources_with_prefix(
+            getattr(clients, params["client"]), prefix, params["resource_key"],
+            params["identifier_key"], service_type=params["service_type"],
+            method=params["method"])
 
-    if is_execute:
-        try:
-            delete_method = getattr(
-                params["client"], params["delete_method_name"])
-            delete_params_key = params["delete_params_key"]
-            requires_list = params.get(
-                "requires_list", params["delete_method_name"] in METHODS_REQUIRING_LIST)
+    if not use_cache:
+        return live()
+    return _handing_out(clients, params, profiling.timed(
+        f"{clients.region} {params['resource_name']} discovery",
+        inventory_cache.cached(clients, _cache_key(params), prefix, live)))
 
-            for resource in resources:
-                logger.info(f"Deleting {params['resource_name']}: {resource}")
 
-                delete_method(
-                    **{delete_params_key: [resource] if requires_list else resource})
+# The IDs discover() handed out this run, by region and service, so
+# settling only waits for resources this run was asked to delete, and
+# those of them whose delete failed.
+_handed_out = {}
+_failed = {}
 
-            logger.info(f"Deleted {params['resource_name']}s: {resources}")
-        except Exception as e:
-            logger.error(f"Failed to delete {params['resource_name']}s: {e}")
-    else:
-        logger.info(f"Planning to delete {
-                    params['resource_name']}s: {resources}")
 
+def _handing_out(clients, params, resource_ids):
+    handed_out = _handed_out.setdefault(
+        (clients.region, params['resource_name']), set())
+    for resource_id in resource_ids:
+        handed_out.add(resource_id)
+        yield resource_id
 
-def delete_vpcs(prefix, is_execute):
-    vpc_ids = get_resources_with_prefix(
-        ec2, prefix, 'Vpcs', 'VpcId', service_type='vpc', method='describe_vpcs')
 
-    if vpc_ids:
-        if is_execute:
-            for vpc_id in vpc_ids:
-                logger.info(f"Deleting resources in VPC: {vpc_id}")
-
-                igws = ec2.describe_internet_gateways(
-                    Filters=[{'Name': 'attachment.vpc-id', 'Values': [vpc_id]}]
-                )['InternetGateways']
-                for igw in igws:
-                    igw_id = igw['InternetGatewayId']
-                    logger.info(
-                        f"Detaching and deleting internet gateway: {igw_id}")
-                    ec2.detach_internet_gateway(
-                        InternetGatewayId=igw_id, VpcId=vpc_id)
-                    ec2.delete_internet_gateway(InternetGatewayId=igw_id)
-
-                subnets = ec2.describe_subnets(
-                    Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])['Subnets']
-                for subnet in subnets:
-                    subnet_id = subnet['SubnetId']
-                    logger.info(f"Deleting subnet: {subnet_id}")
-                    ec2.delete_subnet(SubnetId=subnet_id)
-
-                route_tables = ec2.describe_route_tables(
-                    Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])['RouteTables']
-                for rt in route_tables:
-                    if not rt['Associations'][0]['Main']:
-                        rt_id = rt['RouteTableId']
-                        logger.info(f"Deleting route table: {rt_id}")
-                        ec2.delete_route_table(RouteTableId=rt_id)
-
-                network_interfaces = ec2.describe_network_interfaces(
-                    Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])['NetworkInterfaces']
-                for eni in network_interfaces:
-                    eni_id = eni['NetworkInterfaceId']
-                    logger.info(f"Deleting network interface: {eni_id}")
-                    ec2.delete_network_interface(NetworkInterfaceId=eni_id)
-
-                logger.info(f"Deleting VPC: {vpc_id}")
-                ec2.delete_vpc(VpcId=vpc_id)
-            logger.info(f"Deleted VPCs: {vpc_ids}")
+def delete_resources(params, prefix, is_execute=False, clients=DEFAULT_CLIENTS,
+                     logger=logger):
+    """Generalised function to delete resources or plan deletion using AWS clients.
+
+    Returns (found, failed) counts. Once the run's deadline is near, no
+    more resources are taken and DeadlineReached is raised with the
+    counts instead.
+    """
+    client = getattr(clients, params["client"])
+    resources = discover(params, prefix, clients)
+
+    delete_method = getattr(client, params["delete_method_name"])
+    delete_params_key = params["delete_params_key"]
+    batch_size = params.get(
+        "batch_size", BATCH_DELETE_LIMITS.get(params["delete_method_name"]))
+
+    before_delete = params.get("before_delete")
+
+    stopped = False
+
+    def announce():
+        nonlocal stopped
+        for resource in resources:
+            if deadline.expired():
+                stopped = True
+                return
+            logger.info(
+                f"{action_verb('delete', is_execute)} {params['resource_name']}: {resource}",
+                extra={'service': params['resource_name'], 'resource_id': resource,
+                       'action': 'delete'})
+            yield resource
+
+    def delete_batch(batch):
+        deadline.check()
+        delete_method(**{delete_params_key: batch})
+
+    def delete_one(resource):
+        deadline.check()
+        if before_delete:
+            before_delete(client, resource, logger)
+        delete_method(**{delete_params_key: resource})
+
+    if not is_execute:
+        count = sum(1 for _ in announce())
+        if stopped:
+            raise DeadlineReached(count)
+        if count:
+            logger.info(
+                f"Planning to delete {count} {params['resource_name']}(s)")
         else:
-            logger.info(f"Planning to delete VPCs: {vpc_ids}")
+            logger.info(
+                f"No {params['resource_name']}s found with prefix '{prefix}'")
+        return count, 0
+
+    if batch_size:
+        outcomes = run_batched(announce(), delete_batch, batch_size)
     else:
+        outcomes = (
+            (resource, error)
+            for resource, _, error in run_in_pool(announce(), delete_one, 1)
+        )
+
+    count = failed = undone = 0
+    for resource, error in outcomes:
+        count += 1
+        if error is None:
+            continue
+        fields = {'service': params['resource_name'], 'resource_id': resource,
+                  'action': 'delete'}
+        if isinstance(error, DeadlineReached):
+            undone += 1
+            logger.warning(
+                f"Left {params['resource_name']} {resource} undone at the deadline",
+                extra={**fields, 'outcome': 'undone'})
+        elif is_not_found(error):
+            logger.info(
+                f"{params['resource_name']} {resource} is already deleted",
+                extra={**fields, 'outcome': 'already_deleted'})
+        else:
+            failed += 1
+            _failed.setdefault(
+                (clients.region, params['resource_name']), set()).add(resource)
+            logger.error(
+                f"Failed to delete {params['resource_name']}: {resource} - {error}",
+                extra={**fields, 'outcome': 'failed', 'error': str(error)})
+
+    if stopped or undone:
+        raise DeadlineReached(count, failed, undone)
+    if count:
+        logger.info(f"Deleted {count} {params['resource_name']}(s)")
+    else:
+        logger.info(
+            f"No {params['resource_name']}s found with prefix '{prefix}'")
+    return count, failed
+
+
+def delete_vpcs(prefix, is_execute, clients=DEFAULT_CLIENTS, logger=logger):
+    """Delete matching VPCs along with their gateways, subnets, route
+    tables and network interfaces, several VPCs at a time."""
+    vpc_ids = list(discover(FUNCTION_MAP["vpc"], prefix, clients))
+
+    if not is_execute:
+        for vpc_id in vpc_ids:
+            logger.info(f"Planning to delete VPC: {vpc_id}")
+        count, failed = len(vpc_ids), 0
+    else:
+        count, failed = teardown_vpcs(clients.ec2, vpc_ids, logger, is_execute=True)
+
+    if not count:
         logger.info(f"No VPCs found with prefix '{prefix}'")
+    elif is_execute:
+        logger.info(f"Deleted {count - failed} VPC(s)")
+    return count, failed
 
 
 FUNCTION_MAP = {
     "ecs": {
-        "client": ecs,
+        "client": "ecs",
         "resource_key": "clusterArns",
         "identifier_key": "",
         "service_type": "ecs",
@@ -111,7 +185,7 @@ FUNCTION_MAP = {
         "delete_params_key": "cluster"
     },
     "lambda": {
-        "client": lambda_client,
+        "client": "lambda_client",
         "resource_key": "Functions",
         "identifier_key": "FunctionName",
         "service_type": "lambda",
@@ -121,7 +195,7 @@ FUNCTION_MAP = {
         "delete_params_key": "FunctionName"
     },
     "step": {
-        "client": sfn,
+        "client": "sfn",
         "resource_key": "stateMachines",
         "identifier_key": "stateMachineArn",
         "service_type": "stepfunctions",
@@ -131,7 +205,7 @@ FUNCTION_MAP = {
         "delete_params_key": "stateMachineArn"
     },
     "sns": {
-        "client": sns,
+        "client": "sns",
         "resource_key": "Topics",
         "identifier_key": "TopicArn",
         "service_type": "sns",
@@ -141,7 +215,7 @@ FUNCTION_MAP = {
         "delete_params_key": "TopicArn"
     },
     "amplify": {
-        "client": amplify,
+        "client": "amplify",
         "resource_key": "apps",
         "identifier_key": "appId",
         "service_type": "amplify",
@@ -151,7 +225,7 @@ FUNCTION_MAP = {
         "delete_params_key": "appId"
     },
     "ecr": {
-        "client": ecr,
+        "client": "ecr",
         "resource_key": "repositories",
         "identifier_key": "repositoryName",
         "service_type": "ecr",
@@ -161,7 +235,7 @@ FUNCTION_MAP = {
         "delete_params_key": "repositoryName"
     },
     "elbv2": {
-        "client": elbv2,
+        "client": "elbv2",
         "resource_key": "LoadBalancers",
         "identifier_key": "LoadBalancerArn",
         "service_type": "elbv2",
@@ -171,7 +245,7 @@ FUNCTION_MAP = {
         "delete_params_key": "LoadBalancerArn"
     },
     "tg": {
-        "client": elbv2,
+        "client": "elbv2",
         "resource_key": "TargetGroups",
         "identifier_key": "TargetGroupArn",
         "service_type": "elbv2",
@@ -181,17 +255,17 @@ FUNCTION_MAP = {
         "delete_params_key": "TargetGroupArn"
     },
     "ec2": {
-        "client": ec2,
+        "client": "ec2",
         "resource_key": "Reservations",
         "identifier_key": "InstanceId",
         "service_type": "ec2",
         "method": "describe_instances",
         "resource_name": "EC2 instance",
         "delete_method_name": "terminate_instances",
-        "delete_params_key": "InstanceId"
+        "delete_params_key": "InstanceIds"
     },
     "elasticache": {
-        "client": elasticache,
+        "client": "elasticache",
         "resource_key": "CacheClusters",
         "identifier_key": "CacheClusterId",
         "service_type": "elasticache",
@@ -201,7 +275,7 @@ FUNCTION_MAP = {
         "delete_params_key": "CacheClusterId"
     },
     "rds": {
-        "client": rds,
+        "client": "rds",
         "resource_key": "DBInstances",
         "identifier_key": "DBInstanceIdentifier",
         "service_type": "rds",
@@ -211,7 +285,7 @@ FUNCTION_MAP = {
         "delete_params_key": "DBInstanceIdentifier"
     },
     "redshift": {
-        "client": redshift,
+        "client": "redshift",
         "resource_key": "Clusters",
         "identifier_key": "ClusterIdentifier",
         "service_type": "redshift",
@@ -221,7 +295,7 @@ FUNCTION_MAP = {
         "delete_params_key": "ClusterIdentifier"
     },
     "sg": {
-        "client": ec2,
+        "client": "ec2",
         "resource_key": "SecurityGroups",
         "identifier_key": "GroupId",
         "service_type": "security_group",
@@ -231,17 +305,18 @@ FUNCTION_MAP = {
         "delete_params_key": "GroupId"
     },
     "s3": {
-        "client": s3,
+        "client": "s3",
         "resource_key": "Buckets",
         "identifier_key": "Name",
         "service_type": "s3",
         "method": "list_buckets",
         "resource_name": "S3 bucket",
         "delete_method_name": "delete_bucket",
-        "delete_params_key": "Bucket"
+        "delete_params_key": "Bucket",
+        "before_delete": empty_bucket
     },
     "vpc": {
-        "client": ec2,
+        "client": "ec2",
         "resource_key": "Vpcs",
         "identifier_key": "VpcId",
         "service_type": "vpc",
@@ -253,12 +328,75 @@ FUNCTION_MAP = {
 }
 
 
+def _run_handler(flag, params, prefix, is_execute, clients, logger):
+    if flag != "vpc":
+        return delete_resources(params, prefix, is_execute, clients, logger)
+    return delete_vpcs(prefix, is_execute, clients, logger)
+
+
+def run_region(args, is_execute, clients, logger, waiter):
+    def run_service(flag):
+        params = FUNCTION_MAP[flag]
+        resource_name = params['resource_name']
+        if is_execute:
+            logger.info(
+                f"Executing {resource_name} deletion with prefix '{args.prefix}'")
+        else:
+            logger.info(
+                f"Planning to delete {resource_name}s with prefix '{args.prefix}'")
+        try:
+            if args.invalidate_cache:
+                inventory_cache.invalidate(
+                    clients.account_id, clients.region, _cache_key(params), args.prefix)
+            with profiling.phase(
+                    f"{clients.region} {resource_name} deletion",
+                    excluding=f"{clients.region} {resource_name} discovery"):
+                found, failed = _run_handler(
+                    flag, params, args.prefix, is_execute, clients, logger)
+            if is_execute and not args.no_cache:
+                inventory_cache.invalidate(
+                    clients.account_id, clients.region, _cache_key(params), args.prefix)
+            return ServiceResult(clients.region, flag, found, failed)
+        except DeadlineReached as e:
+            logger.warning(f"Stopped {resource_name} deletion: {e}")
+            if is_execute and not args.no_cache:
+                inventory_cache.invalidate(
+                    clients.account_id, clients.region, _cache_key(params), args.prefix)
+            return ServiceResult(clients.region, flag, e.found, e.failed, undone=e.undone)
+        except Exception as e:
+            logger.error(f"Failed to delete {resource_name}s: {e}")
+            return ServiceResult(clients.region, flag, 0, 0, str(e))
+
+    def settle(flag, result):
+        if not is_execute or result.error or not result.found:
+            return True
+        params = FUNCTION_MAP[flag]
+        logger.info(f"Waiting for {params['resource_name']}s to be deleted")
+        key = (clients.region, params['resource_name'])
+        deleting = _handed_out.get(key, set())
+        watch = waiter.track(
+            params['resource_name'],
+            lambda: deleting.intersection(discover(params, args.prefix, clients, use_cache=False)),
+            logger, allowed=result.failed + result.undone,
+            expected=deleting - _failed.get(key, set()))
+        with profiling.phase(f"{clients.region} {params['resource_name']} settle"):
+            return waiter.wait(watch, timeout=deadline.clamp(args.settle_timeout))
+
+    flags = [flag for flag in FUNCTION_MAP if getattr(args, flag)]
+    return run_scheduled(
+        flags, run_service, settle, logger, settle_all=args.wait,
+        not_started=lambda flag: ServiceResult(clients.region, flag, 0, 0, NOT_STARTED))
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Delete AWS resources with a given prefix.")
 
-    parser.add_argument('--prefix', type=str, required=True,
-                        help="Prefix for filtering AWS resources.")
+    parser.add_argument('--prefix', action='append', required=True,
+                        help="Prefix for filtering AWS resources. Repeat to match several prefixes in one run.")
+
+    parser.add_argument('--exclude', action='append', default=[],
+                        help="Skip resources matching this prefix even if they match --prefix. Can be repeated.")
 
     for flag in FUNCTION_MAP.keys():
         parser.add_argument(f'--{flag}', action='store_true',
@@ -267,22 +405,86 @@ def main():
     parser.add_argument('--execute', action='store_true',
                         help="Run in execute mode to actually delete the resources. Default is plan mode.")
 
+    parser.add_argument('--regions', nargs='+',
+                        help="Regions to clean up, space or comma separated, or 'all' for every enabled region. Default is the profile's region.")
+
+    parser.add_argument('--wait', action='store_true',
+                        help="In execute mode, wait until every deleted resource is confirmed gone before exiting.")
+
+    parser.add_argument('--cache-ttl', type=int, default=inventory_cache.DEFAULT_TTL,
+                        help=f"Seconds a plan run's inventory stays valid for a following execute run. Default is {inventory_cache.DEFAULT_TTL}.")
+
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Neither read nor write the local inventory cache.")
+
+    parser.add_argument('--invalidate-cache', action='store_true',
+                        help="Drop cached inventory for the selected services and regions before running.")
+
+    parser.add_argument('--log-json', metavar='PATH',
+                        help="Also write every log record, with its service, resource ID, action, outcome and duration, to this file as JSON lines.")
+
+    parser.add_argument('--metrics-json', metavar='PATH',
+                        help="Write per-operation API call metrics (counts, latency histograms, retries, throttles, bytes) to this JSON file.")
+
+    parser.add_argument('--metrics-prom', metavar='PATH',
+                        help="Write the same metrics in Prometheus text format, e.g. for the node exporter's textfile collector.")
+
+    parser.add_argument('--metrics-interval', type=int, default=metrics.DEFAULT_EXPORT_INTERVAL,
+                        help=f"Seconds between metrics file updates during the run; 0 writes them only at the end. Default is {metrics.DEFAULT_EXPORT_INTERVAL}.")
+
+    parser.add_argument('--settle-timeout', type=int, default=DEFAULT_SETTLE_TIMEOUT,
+                        help=f"Seconds to wait for a service's resources to be gone before its dependents start. Default is {DEFAULT_SETTLE_TIMEOUT}.")
+
+    parser.add_argument('--deadline', type=int, metavar='SECONDS',
+                        help="Finish the run within this many seconds. New work stops while calls already sent can still complete, and what is left undone is reported. Default is no limit.")
+
+    parser.add_argument('--connect-timeout', type=int, default=DEFAULT_CONNECT_TIMEOUT,
+                        help=f"Seconds each API call attempt may take to connect. Default is {DEFAULT_CONNECT_TIMEOUT}.")
+
+    parser.add_argument('--read-timeout', type=int, default=DEFAULT_READ_TIMEOUT,
+                        help=f"Seconds each API call attempt may wait for a response. Default is {DEFAULT_READ_TIMEOUT}.")
+
+    parser.add_argument('--profile', metavar='REPORT',
+                        help="Profile the run and write a report of wall time per phase, import time, peak memory with the top allocation sites, and CPU time per function to this file. Slows the run down.")
+
     args = parser.parse_args()
+    if args.deadline is not None and args.deadline < 1:
+        parser.error("--deadline must be at least 1")
+    if args.connect_timeout < 1 or args.read_timeout < 1:
+        parser.error("--connect-timeout and --read-timeout must be at least 1")
+    with profiling.profiled(args.profile, 'delete_compact'):
+        run(args)
+
+
+def run(args):
+    """Run the deletions the parsed arguments ask for."""
+    args.prefix = PrefixMatcher(args.prefix, args.exclude)
 
     is_execute = args.execute
+    get_logger(is_execute, args.log_json)
+    configure(connect_timeout=args.connect_timeout, read_timeout=args.read_timeout)
+    if args.deadline:
+        deadline.configure(time.time() + args.deadline, deadline.reserve_for(
+            args.deadline, args.connect_timeout, args.read_timeout))
+    inventory_cache.configure(
+        ttl=args.cache_ttl,
+        read=is_execute and not args.no_cache,
+        write=not is_execute and not args.no_cache)
 
-    for flag, params in FUNCTION_MAP.items():
-        if getattr(args, flag):
-            if is_execute:
-                logger.info(f"Executing {params['resource_name']} deletion with prefix '{
-                            args.prefix}'")
-            else:
-                logger.info(f"Planning to delete {
-                            params['resource_name']}s with prefix '{args.prefix}'")
-            if flag != "vpc":
-                delete_resources(params, args.prefix, is_execute)
-            else:
-                delete_vpcs(args.prefix, is_execute)
+    client_sets = client_sets_for(resolve_regions(args.regions))
+    profiling.mark('startup')
+    exporter = MetricsExporter(
+        args.metrics_json, args.metrics_prom, args.metrics_interval)
+    with exporter, WaiterEngine() as waiter:
+        results = run_in_regions(
+            client_sets,
+            lambda clients, region_logger: run_region(
+                args, is_execute, clients, region_logger, waiter),
+            logger)
+    log_report(logger, results)
+    metrics.log_summary(logger)
+    if any(result.undone or result.error == NOT_STARTED for result in results):
+        logger.warning("The deadline was reached before all work was done")
 
 
 if __name__ == "__main__":
@@ -1,334 +1,422 @@
-from aws_clients import (
-    rds, ec2, ecs, redshift,
-    elasticache, elbv2, ecr,
-    amplify, sns, sfn,
-    lambda_client, s3
-)
-from prefix_filter import get_resources_with_prefix
-from logging_config import get_logger
+from aws_clients import (DEFAULT_CLIENTS, DEFAULT_CONNECT_TIMEOUT, DEFAULT_MAX_POOL_CONNECTIONS,
+                         DEFAULT_READ_TIMEOUT, ClientSet, configure)
+from prefix_filter import PrefixMatcher, get_resources_with_prefix
+from aws_errors import is_not_found
+from deadline import NOT_STARTED, DeadlineReached
+import deadline
+import inventory_cache
+import profiling
+import tagging_discovery
+from logging_config import action_verb, forward_logs, get_logger
+from executor import DEFAULT_WORKERS, run_in_pool
+from batching import BATCH_DELETE_LIMITS, run_batched
+from regions import RegionLogger, client_sets_for, resolve_regions, run_in_regions
+from report import ServiceResult, log_report
+from accounts import (DEFAULT_ACCOUNT_WORKERS, DEFAULT_ROLE_NAME, AccountLogger,
+                      account_of, assume_role, resolve_accounts, run_in_accounts)
+from s3_emptier import empty_and_delete_bucket
+from scheduler import DEFAULT_SETTLE_TIMEOUT, dependency_levels, run_scheduled
+from plan_file import Plan, PlanError, PlanRecorder
+import plan_file
+from journal import DEFAULT_JOURNAL, Journal, JournalError, account_journal
+import journal
+from waiters import WaiterEngine
+from work_queue import (DEFAULT_LOCAL_WORKERS, DEFAULT_VISIBILITY_TIMEOUT, POLL_INTERVAL, LeasedBatch,
+                        WorkQueue, WorkQueueError, worker_id)
+from metrics import MetricsExporter
+import metrics
+from vpc_teardown import teardown_vpcs
 import argparse
+import logging
+import multiprocessing
+import sqlite3
+import time
+from contextlib import nullcontext
+from functools import partial
+
+
+# Flag -> (ClientSet attribute, resource_key, identifier_key, service_type,
+# method) as passed to get_resources_with_prefix.
+DISCOVERY = {
+    "ecs": ('ecs', 'clusterArns', '', 'ecs', 'list_clusters'),
+    "lambda": ('lambda_client', 'Functions', 'FunctionName', 'lambda', 'list_functions'),
+    "step": ('sfn', 'stateMachines', 'stateMachineArn', 'stepfunctions', 'list_state_machines'),
+    "sns": ('sns', 'Topics', 'TopicArn', 'sns', 'list_topics'),
+    "amplify": ('amplify', 'apps', 'appId', 'amplify', 'list_apps'),
+    "ecr": ('ecr', 'repositories', 'repositoryName', 'ecr', 'describe_repositories'),
+    "elbv2": ('elbv2', 'LoadBalancers', 'LoadBalancerArn', 'elbv2', 'describe_load_balancers'),
+    "tg": ('elbv2', 'TargetGroups', 'TargetGroupArn', 'elbv2', 'describe_target_groups'),
+    "ec2": ('ec2', 'Reservations', 'InstanceId', 'ec2', 'describe_instances'),
+    "elasticache": ('elasticache', 'CacheClusters', 'CacheClusterId', 'elasticache', 'describe_cache_clusters'),
+    "rds": ('rds', 'DBInstances', 'DBInstanceIdentifier', 'rds', 'describe_db_instances'),
+    "redshift": ('redshift', 'Clusters', 'ClusterIdentifier', 'redshift', 'describe_clusters'),
+    "s3": ('s3', 'Buckets', 'Name', 's3', 'list_buckets'),
+    "sg": ('ec2', 'SecurityGroups', 'GroupId', 'security_group', 'describe_security_groups'),
+    "vpc": ('ec2', 'Vpcs', 'VpcId', 'vpc', 'describe_vpcs'),
+}
 
 
-def delete_ecs_clusters(prefix, logger, is_execute=False):
-    cluster_arns = get_resources_with_prefix(
-        ecs, prefix, 'clusterArns', '', service_type='ecs', method='list_clusters')
-
-    if cluster_arns:
-        for cluster_arn in cluster_arns:
-            logger.info(f"Deleting ECS cluster: {cluster_arn}")
-            if is_execute:
-                try:
-                    ecs.delete_cluster(cluster=cluster_arn)
-                except Exception as e:
-                    logger.error(
-                        f"Failed to delete ECS cluster: {cluster_arn} - {e}")
-                    cluster_arns.remove(cluster_arn)
+def discover(flag, prefix, clients=DEFAULT_CLIENTS, use_cache=True):
+    """Yield the IDs of a service's resources matching prefix.
+
+    With use_cache, results may come from a resumed journal, an applied
+    plan, the inventory cache or the region's tagging index (see
+    journal.configure, plan_file.configure, inventory_cache.configure and
+    tagging_discovery.configure) instead of the service's own listing.
+    Without it the service is always listed directly, which is what
+    confirming deletions needs.
+    """
+    client_name, resource_key, identifier_key, service_type, method = DISCOVERY[flag]
+
+    def live():
+        return get_resources_with_prefix(
+            getattr(clients, client_name), prefix, resource_key, identifier_key,
+            service_type=service_type, method=method)
+
+    if not use_cache:
+        return live()
+    return _handing_out(clients, flag, profiling.timed(
+        f"{clients.region} {flag} discovery", journal.journaled(
+            clients, flag,
+            lambda: plan_file.planned(
+                clients, flag,
+                lambda: inventory_cache.cached(
+                    clients, f"{service_type}:{resource_key}", prefix,
+                    lambda: tagging_discovery.tagged(
+                        clients, flag, prefix, identifier_key, service_type, live))))))
+
+
+# The IDs discover() handed to the handlers this run, by (credentials,
+# region, flag). Settling only waits for these, not for resources created
+# under the prefix since, which nothing was asked to delete.
+_handed_out = {}
+
+
+def _handing_out(clients, flag, resource_ids):
+    handed_out = _handed_out.setdefault(
+        (clients.credentials, clients.region, flag), set())
+    for resource_id in resource_ids:
+        handed_out.add(resource_id)
+        yield resource_id
+
+
+def handed_out(clients, flag):
+    """Return the IDs discover() has handed out for flag in a region."""
+    return _handed_out.get((clients.credentials, clients.region, flag), set())
+
+
+def invalidate_cache(flag, prefix, clients):
+    _, resource_key, _, service_type, _ = DISCOVERY[flag]
+    inventory_cache.invalidate(
+        clients.account_id, clients.region, f"{service_type}:{resource_key}", prefix)
+
+
+def _delete_all(resource_ids, delete, resource_name, logger, is_execute, workers,
+                verb='delete', batch_size=None, track=None):
+    """Log every resource and, in execute mode, delete them on a thread pool.
+
+    With batch_size set, delete is called with lists of up to batch_size
+    IDs instead of one ID at a time. Failures are logged per resource in
+    discovery order, and successes at DEBUG level with how long the call
+    took. With track, each outcome is also recorded in the journal.
+    Returns (found, failed) counts.
+
+    Once the run's deadline is near, no more resources are taken from
+    resource_ids and queued deletes that have not started are dropped.
+    Those are left out of the journal, so --resume picks them up, and
+    DeadlineReached is raised with the counts instead of returning them.
+    """
+    stopped = False
+
+    def fields(resource_id, **extra):
+        return {'service': resource_name, 'resource_id': resource_id,
+                'action': verb, **extra}
+
+    def announce():
+        nonlocal stopped
+        for resource_id in resource_ids:
+            if deadline.expired():
+                stopped = True
+                return
+            logger.info(
+                f"{action_verb(verb, is_execute)} {resource_name}: {resource_id}",
+                extra=fields(resource_id, outcome=None if is_execute else 'planned'))
+            yield resource_id
+
+    if not is_execute:
+        found = sum(1 for _ in announce())
+        if stopped:
+            raise DeadlineReached(found)
+        return found, 0
+
+    def checked_delete(batch):
+        deadline.check()
+        delete(batch)
+
+    def timed_delete(resource_id):
+        deadline.check()
+        started = time.monotonic()
+        delete(resource_id)
+        return time.monotonic() - started
+
+    if batch_size:
+        outcomes = (
+            (resource_id, None, error)
+            for resource_id, error in run_batched(
+                announce(), checked_delete, batch_size, workers)
+        )
     else:
+        outcomes = run_in_pool(announce(), timed_delete, workers)
+
+    count = failed = undone = 0
+    for resource_id, duration, error in outcomes:
+        count += 1
+        if isinstance(error, DeadlineReached):
+            undone += 1
+            logger.warning(
+                f"Left {resource_name} {resource_id} undone at the deadline",
+                extra=fields(resource_id, outcome='undone'))
+            continue
+        if track is not None:
+            if error is None:
+                track.issued(resource_id)
+            elif is_not_found(error):
+                track.confirmed(resource_id)
+            else:
+                track.failed(resource_id)
+        if error is None:
+            logger.debug(
+                f"Deleted {resource_name}: {resource_id}",
+                extra=fields(resource_id, outcome='deleted',
+                             duration=duration and round(duration, 3)))
+        elif is_not_found(error):
+            logger.info(
+                f"{resource_name} {resource_id} is already deleted",
+                extra=fields(resource_id, outcome='already_deleted'))
+        else:
+            failed += 1
+            logger.error(
+                f"Failed to {verb} {resource_name}: {resource_id} - {error}",
+                extra=fields(resource_id, outcome='failed', error=str(error)))
+    if stopped or undone:
+        raise DeadlineReached(count, failed, undone)
+    return count, failed
+
+
+def delete_ecs_clusters(prefix, logger, is_execute=False, workers=DEFAULT_WORKERS,
+        clients=DEFAULT_CLIENTS):
+    cluster_arns = discover('ecs', prefix, clients)
+
+    found, failed = _delete_all(
+        cluster_arns, lambda arn: clients.ecs.delete_cluster(cluster=arn),
+        'ECS cluster', logger, is_execute, workers,
+        track=journal.tracker(clients, 'ecs'))
+    if not found:
         logger.info(f"No ECS clusters found with prefix '{prefix}'")
+    return found, failed
 
 
-def delete_lambda_functions(prefix, logger, is_execute=False):
-    function_names = get_resources_with_prefix(
-        lambda_client, prefix, 'Functions', 'FunctionName', service_type='lambda', method='list_functions')
+def delete_lambda_functions(prefix, logger, is_execute=False, workers=DEFAULT_WORKERS,
+        clients=DEFAULT_CLIENTS):
+    function_names = discover('lambda', prefix, clients)
 
-    if function_names:
-        for function_name in function_names:
-            logger.info(f"Deleting Lambda function: {function_name}")
-            if is_execute:
-                try:
-                    lambda_client.delete_function(FunctionName=function_name)
-                except Exception as e:
-                    logger.error(
-                        f"Failed to delete Lambda function: {function_name} - {e}")
-                    function_names.remove(function_name)
-    else:
+    found, failed = _delete_all(
+        function_names, lambda name: clients.lambda_client.delete_function(FunctionName=name),
+        'Lambda function', logger, is_execute, workers,
+        track=journal.tracker(clients, 'lambda'))
+    if not found:
         logger.info(f"No Lambda functions found with prefix '{prefix}'")
+    return found, failed
 
 
-def delete_step_functions(prefix, logger, is_execute=False):
-    state_machine_arns = get_resources_with_prefix(
-        sfn, prefix, 'stateMachines', 'stateMachineArn', service_type='stepfunctions', method='list_state_machines')
+def delete_step_functions(prefix, logger, is_execute=False, workers=DEFAULT_WORKERS,
+        clients=DEFAULT_CLIENTS):
+    state_machine_arns = discover('step', prefix, clients)
 
-    if state_machine_arns:
-        for arn in state_machine_arns:
-            logger.info(f"Deleting Step Function state machine: {arn}")
-            if is_execute:
-                try:
-                    sfn.delete_state_machine(stateMachineArn=arn)
-                except Exception as e:
-                    logger.error(
-                        f"Failed to delete Step Function state machine: {arn} - {e}")
-                    state_machine_arns.remove(arn)
-    else:
+    found, failed = _delete_all(
+        state_machine_arns, lambda arn: clients.sfn.delete_state_machine(stateMachineArn=arn),
+        'Step Function state machine', logger, is_execute, workers,
+        track=journal.tracker(clients, 'step'))
+    if not found:
         logger.info(
             f"No Step Function state machines found with prefix '{prefix}'")
+    return found, failed
 
 
-def delete_sns_topics(prefix, logger, is_execute=False):
-    topic_arns = get_resources_with_prefix(
-        sns, prefix, 'Topics', 'TopicArn', service_type='sns', method='list_topics')
+def delete_sns_topics(prefix, logger, is_execute=False, workers=DEFAULT_WORKERS,
+        clients=DEFAULT_CLIENTS):
+    topic_arns = discover('sns', prefix, clients)
 
-    if topic_arns:
-        for topic_arn in topic_arns:
-            logger.info(f"Deleting SNS topic: {topic_arn}")
-            if is_execute:
-                try:
-                    sns.delete_topic(TopicArn=topic_arn)
-                except Exception as e:
-                    logger.error(
-                        f"Failed to delete SNS topic: {topic_arn} - {e}")
-                    topic_arns.remove(topic_arn)
-    else:
+    found, failed = _delete_all(
+        topic_arns, lambda arn: clients.sns.delete_topic(TopicArn=arn),
+        'SNS topic', logger, is_execute, workers,
+        track=journal.tracker(clients, 'sns'))
+    if not found:
         logger.info(f"No SNS topics found with prefix '{prefix}'")
+    return found, failed
 
 
-def delete_amplify_apps(prefix, logger, is_execute=False):
-    app_ids = get_resources_with_prefix(
-        amplify, prefix, 'apps', 'appId', service_type='amplify', method='list_apps')
+def delete_amplify_apps(prefix, logger, is_execute=False, workers=DEFAULT_WORKERS,
+        clients=DEFAULT_CLIENTS):
+    app_ids = discover('amplify', prefix, clients)
 
-    if app_ids:
-        for app_id in app_ids:
-            logger.info(f"Deleting Amplify app: {app_id}")
-            if is_execute:
-                try:
-                    amplify.delete_app(appId=app_id)
-                except Exception as e:
-                    logger.error(
-                        f"Failed to delete Amplify app: {app_id} - {e}")
-                    app_ids.remove(app_id)
-    else:
+    found, failed = _delete_all(
+        app_ids, lambda app_id: clients.amplify.delete_app(appId=app_id),
+        'Amplify app', logger, is_execute, workers,
+        track=journal.tracker(clients, 'amplify'))
+    if not found:
         logger.info(f"No Amplify apps found with prefix '{prefix}'")
+    return found, failed
 
 
-def delete_ecr_repositories(prefix, logger, is_execute=False):
-    repository_names = get_resources_with_prefix(
-        ecr, prefix, 'repositories', 'repositoryName', service_type='ecr', method='describe_repositories')
+def delete_ecr_repositories(prefix, logger, is_execute=False, workers=DEFAULT_WORKERS,
+        clients=DEFAULT_CLIENTS):
+    repository_names = discover('ecr', prefix, clients)
 
-    if repository_names:
-        for repo_name in repository_names:
-            logger.info(f"Deleting ECR repository: {repo_name}")
-            if is_execute:
-                try:
-                    ecr.delete_repository(
-                        repositoryName=repo_name,
-                        force=True
-                    )
-                except Exception as e:
-                    logger.error(
-                        f"Failed to delete ECR repository: {repo_name} - {e}")
-                    repository_names.remove(repo_name)
-    else:
+    found, failed = _delete_all(
+        repository_names,
+        lambda name: clients.ecr.delete_repository(repositoryName=name, force=True),
+        'ECR repository', logger, is_execute, workers,
+        track=journal.tracker(clients, 'ecr'))
+    if not found:
         logger.info(f"No ECR repositories found with prefix '{prefix}'")
+    return found, failed
 
 
-def delete_load_balancers(prefix, logger, is_execute=False):
-    lb_arns = get_resources_with_prefix(
-        elbv2, prefix, 'LoadBalancers', 'LoadBalancerArn', service_type='elbv2', method='describe_load_balancers')
+def delete_load_balancers(prefix, logger, is_execute=False, workers=DEFAULT_WORKERS,
+        clients=DEFAULT_CLIENTS):
+    lb_arns = discover('elbv2', prefix, clients)
 
-    if lb_arns:
-        for lb_arn in lb_arns:
-            logger.info(f"Deleting Load Balancer: {lb_arn}")
-            if is_execute:
-                try:
-                    elbv2.delete_load_balancer(LoadBalancerArn=lb_arn)
-                except Exception as e:
-                    logger.error(
-                        f"Failed to delete Load Balancer: {lb_arn} - {e}")
-                    lb_arns.remove(lb_arn)
-    else:
+    found, failed = _delete_all(
+        lb_arns, lambda arn: clients.elbv2.delete_load_balancer(LoadBalancerArn=arn),
+        'Load Balancer', logger, is_execute, workers,
+        track=journal.tracker(clients, 'elbv2'))
+    if not found:
         logger.info(f"No Load Balancers found with prefix '{prefix}'")
+    return found, failed
 
 
-def delete_target_groups(prefix, logger, is_execute=False):
-    target_group_arns = get_resources_with_prefix(
-        elbv2, prefix, 'TargetGroups', 'TargetGroupArn', service_type='elbv2b', method='describe_target_groups')
+def delete_target_groups(prefix, logger, is_execute=False, workers=DEFAULT_WORKERS,
+        clients=DEFAULT_CLIENTS):
+    target_group_arns = discover('tg', prefix, clients)
 
-    if target_group_arns:
-        for target_group_arn in target_group_arns:
-            logger.info(f"Deleting Target Group: {target_group_arn}")
-            if is_execute:
-                try:
-                    elbv2.delete_target_group(TargetGroupArn=target_group_arn)
-                except Exception as e:
-                    logger.error(
-                        f"Failed to delete Target Group: {target_group_arn} - {e}")
-                    target_group_arns.remove(target_group_arn)
-    else:
+    found, failed = _delete_all(
+        target_group_arns, lambda arn: clients.elbv2.delete_target_group(TargetGroupArn=arn),
+        'Target Group', logger, is_execute, workers,
+        track=journal.tracker(clients, 'tg'))
+    if not found:
         logger.info(f"No Target Groups found with prefix '{prefix}'")
+    return found, failed
 
 
-def delete_ec2_instances(prefix, logger, is_execute=False):
-    instance_ids = get_resources_with_prefix(
-        ec2, prefix, 'Reservations', 'InstanceId', service_type='ec2', method='')
+def _terminate_ec2_instances(clients, instance_ids, logger):
+    response = clients.ec2.terminate_instances(InstanceIds=instance_ids)
+    for instance in response['TerminatingInstances']:
+        if instance['PreviousState']['Name'] == 'terminated':
+            logger.info(
+                f"Instance {instance['InstanceId']} is already terminated.")
 
-    if instance_ids:
-        for instance_id in instance_ids:
-            logger.info(f"Terminating EC2 instance: {instance_id}")
-            if is_execute:
-                try:
-                    instance_state = ec2.describe_instances(InstanceIds=[instance_id])[
-                        'Reservations'][0]['Instances'][0]['State']['Name']
-                    if instance_state != 'terminated':
-                        ec2.terminate_instances(InstanceIds=[instance_id])
-                    else:
-                        logger.info(
-                            f"Instance {instance_id} is already terminated.")
-                except Exception as e:
-                    logger.error(
-                        f"Failed to terminate EC2 instance: {instance_id} - {e}")
-                    instance_ids.remove(instance_id)
-    else:
-        logger.info(f"No EC2 instances found with prefix '{prefix}'")
 
+def delete_ec2_instances(prefix, logger, is_execute=False, workers=DEFAULT_WORKERS,
+        clients=DEFAULT_CLIENTS):
+    instance_ids = discover('ec2', prefix, clients)
 
-def delete_elasticache_clusters(prefix, logger, is_execute=False):
-    cluster_ids = get_resources_with_prefix(
-        elasticache, prefix, 'CacheClusters', 'CacheClusterId', service_type='elasticache', method='describe_cache_clusters')
-
-    if cluster_ids:
-        for cluster_id in cluster_ids:
-            logger.info(f"Deleting ElastiCache cluster: {cluster_id}")
-            if is_execute:
-                try:
-                    elasticache.delete_cache_cluster(
-                        CacheClusterId=cluster_id
-                    )
-                except Exception as e:
-                    logger.error(
-                        f"Failed to delete ElastiCache cluster: {cluster_id} - {e}")
-                    cluster_ids.remove(cluster_id)
-    else:
-        logger.info(f"No ElastiCache clusters found with prefix '{prefix}'")
+    found, failed = _delete_all(
+        instance_ids, lambda batch: _terminate_ec2_instances(clients, batch, logger),
+        'EC2 instance', logger, is_execute, workers, verb='terminate',
+        batch_size=BATCH_DELETE_LIMITS['terminate_instances'],
+        track=journal.tracker(clients, 'ec2'))
+    if not found:
+        logger.info(f"No EC2 instances found with prefix '{prefix}'")
+    return found, failed
 
 
-def delete_rds_instances(prefix, logger, is_execute=False):
-    instance_ids = get_resources_with_prefix(
-        rds, prefix, 'DBInstances', 'DBInstanceIdentifier', service_type='rds', method='describe_db_instances')
+def delete_elasticache_clusters(prefix, logger, is_execute=False, workers=DEFAULT_WORKERS,
+        clients=DEFAULT_CLIENTS):
+    cluster_ids = discover('elasticache', prefix, clients)
 
-    if instance_ids:
-        for instance_id in instance_ids:
-            logger.info(f"Deleting RDS instance: {instance_id}")
-            if is_execute:
-                try:
-                    rds.delete_db_instance(
-                        DBInstanceIdentifier=instance_id,
-                        SkipFinalSnapshot=True
-                    )
-                except Exception as e:
-                    logger.error(
-                        f"Failed to delete RDS instance: {instance_id} - {e}")
-                    instance_ids.remove(instance_id)
-    else:
+    found, failed = _delete_all(
+        cluster_ids,
+        lambda cluster_id: clients.elasticache.delete_cache_cluster(
+            CacheClusterId=cluster_id),
+        'ElastiCache cluster', logger, is_execute, workers,
+        track=journal.tracker(clients, 'elasticache'))
+    if not found:
+        logger.info(f"No ElastiCache clusters found with prefix '{prefix}'")
+    return found, failed
+
+
+def delete_rds_instances(prefix, logger, is_execute=False, workers=DEFAULT_WORKERS,
+        clients=DEFAULT_CLIENTS):
+    instance_ids = discover('rds', prefix, clients)
+
+    found, failed = _delete_all(
+        instance_ids,
+        lambda instance_id: clients.rds.delete_db_instance(
+            DBInstanceIdentifier=instance_id,
+            SkipFinalSnapshot=True
+        ),
+        'RDS instance', logger, is_execute, workers,
+        track=journal.tracker(clients, 'rds'))
+    if not found:
         logger.info(f"No RDS instances found with prefix '{prefix}'")
-
-
-def delete_redshift_clusters(prefix, logger,  is_execute=False):
-    cluster_ids = get_resources_with_prefix(
-        redshift, prefix, 'Clusters', 'ClusterIdentifier', service_type='redshift', method='describe_clusters')
-
-    if cluster_ids:
-        for cluster_id in cluster_ids:
-            logger.info(f"Deleting Redshift cluster: {cluster_id}")
-            if is_execute:
-                try:
-                    redshift.delete_cluster(
-                        ClusterIdentifier=cluster_id,
-                        SkipFinalClusterSnapshot=True
-                    )
-                except Exception as e:
-                    logger.error(
-                        f"Failed to delete Redshift cluster: {cluster_id} - {e}")
-                    cluster_ids.remove(cluster_id)
-    else:
+    return found, failed
+
+
+def delete_redshift_clusters(prefix, logger, is_execute=False, workers=DEFAULT_WORKERS,
+        clients=DEFAULT_CLIENTS):
+    cluster_ids = discover('redshift', prefix, clients)
+
+    found, failed = _delete_all(
+        cluster_ids,
+        lambda cluster_id: clients.redshift.delete_cluster(
+            ClusterIdentifier=cluster_id,
+            SkipFinalClusterSnapshot=True
+        ),
+        'Redshift cluster', logger, is_execute, workers,
+        track=journal.tracker(clients, 'redshift'))
+    if not found:
         logger.info(f"No Redshift clusters found with prefix '{prefix}'")
+    return found, failed
 
 
-def delete_s3_buckets(prefix, logger,  is_execute=False):
-    bucket_names = get_resources_with_prefix(
-        s3, prefix, 'Buckets', 'Name', service_type='s3', method='list_buckets')
+def delete_s3_buckets(prefix, logger, is_execute=False, workers=DEFAULT_WORKERS,
+        clients=DEFAULT_CLIENTS):
+    bucket_names = discover('s3', prefix, clients)
 
-    if bucket_names:
-        for bucket_name in bucket_names:
-            logger.info(f"Deleting S3 bucket: {bucket_name}")
-            if is_execute:
-                try:
-                    s3.delete_bucket(Bucket=bucket_name)
-                except Exception as e:
-                    logger.error(
-                        f"Failed to delete S3 bucket: {bucket_name} - {e}")
-                    bucket_names.remove(bucket_name)
-    else:
+    # Buckets go one at a time; each one is emptied with the full pool.
+    found, failed = _delete_all(
+        bucket_names,
+        lambda name: empty_and_delete_bucket(clients.s3, name, logger, workers),
+        'S3 bucket', logger, is_execute, 1,
+        track=journal.tracker(clients, 's3'))
+    if not found:
         logger.info(f"No S3 buckets found with prefix '{prefix}'")
+    return found, failed
 
 
-def delete_security_groups(prefix, logger, is_execute=False):
-    security_group_ids = get_resources_with_prefix(
-        ec2, prefix, 'SecurityGroups', 'GroupId', service_type='security_group', method='describe_security_groups')
+def delete_security_groups(prefix, logger, is_execute=False, workers=DEFAULT_WORKERS,
+        clients=DEFAULT_CLIENTS):
+    security_group_ids = discover('sg', prefix, clients)
 
-    if security_group_ids:
-        for group_id in security_group_ids:
-            logger.info(f"Deleting Security Group: {group_id}")
-            if is_execute:
-                try:
-                    ec2.delete_security_group(GroupId=group_id)
-                except Exception as e:
-                    logger.error(
-                        f"Failed to delete Security Group: {group_id} - {e}")
-                    security_group_ids.remove(group_id)
-    else:
+    found, failed = _delete_all(
+        security_group_ids, lambda group_id: clients.ec2.delete_security_group(GroupId=group_id),
+        'Security Group', logger, is_execute, workers,
+        track=journal.tracker(clients, 'sg'))
+    if not found:
         logger.info(f"No Security Groups found with prefix '{prefix}'")
+    return found, failed
 
 
-def delete_vpcs(prefix, logger,  is_execute=False):
-    vpc_ids = get_resources_with_prefix(
-        ec2, prefix, 'Vpcs', 'VpcId', service_type='vpc', method='describe_vpcs')
+def delete_vpcs(prefix, logger, is_execute=False, workers=DEFAULT_WORKERS,
+        clients=DEFAULT_CLIENTS):
+    vpc_ids = discover('vpc', prefix, clients)
 
-    if vpc_ids:
-        for vpc_id in vpc_ids:
-            logger.info(f"Deleting resources in VPC: {vpc_id}")
-
-            igws = ec2.describe_internet_gateways(
-                Filters=[{'Name': 'attachment.vpc-id', 'Values': [vpc_id]}]
-            )['InternetGateways']
-            for igw in igws:
-                igw_id = igw['InternetGatewayId']
-                logger.info(
-                    f"Detaching and deleting internet gateway: {igw_id}")
-                if is_execute:
-                    ec2.detach_internet_gateway(
-                        InternetGatewayId=igw_id, VpcId=vpc_id)
-                    ec2.delete_internet_gateway(InternetGatewayId=igw_id)
-
-            subnets = ec2.describe_subnets(
-                Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])['Subnets']
-            for subnet in subnets:
-                subnet_id = subnet['SubnetId']
-                logger.info(f"Deleting subnet: {subnet_id}")
-                if is_execute:
-                    ec2.delete_subnet(SubnetId=subnet_id)
-
-            route_tables = ec2.describe_route_tables(
-                Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])['RouteTables']
-            for rt in route_tables:
-                if not rt['Associations'][0]['Main']:
-                    rt_id = rt['RouteTableId']
-                    logger.info(f"Deleting route table: {rt_id}")
-                    if is_execute:
-                        ec2.delete_route_table(RouteTableId=rt_id)
-
-            network_interfaces = ec2.describe_network_interfaces(
-                Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])['NetworkInterfaces']
-            for eni in network_interfaces:
-                eni_id = eni['NetworkInterfaceId']
-                logger.info(f"Deleting network interface: {eni_id}")
-                if is_execute:
-                    ec2.delete_network_interface(NetworkInterfaceId=eni_id)
-
-            logger.info(f"Deleting VPC: {vpc_id}")
-            if is_execute:
-                ec2.delete_vpc(VpcId=vpc_id)
-    else:
+    found, failed = teardown_vpcs(clients.ec2, vpc_ids, logger, is_execute, workers,
+                                  track=journal.tracker(clients, 'vpc'))
+    if not found:
         logger.info(f"No VPCs found with prefix '{prefix}'")
+    return found, failed
 
 
 FUNCTION_MAP = {
@@ -350,12 +438,273 @@ FUNCTION_MAP = {
 }
 
 
+def run_region(args, is_execute, clients, logger, waiter, plan=None,
+               handlers=FUNCTION_MAP):
+    """Run every selected handler against one region's clients.
+
+    Handlers are scheduled by their dependencies, so independent services
+    run in parallel and e.g. security groups wait until the instances and
+    load balancers using them are gone. The waiter engine polls those
+    pending deletions for every service and region in one loop. handlers
+    replaces FUNCTION_MAP, e.g. to queue resources instead of deleting.
+    """
+    if plan is not None:
+        try:
+            plan.check_account(clients)
+        except PlanError as e:
+            logger.error(f"Not applying plan to {clients.region}: {e}")
+            return []
+
+    def run_service(flag):
+        func = handlers[flag]
+        try:
+            if args.invalidate_cache:
+                invalidate_cache(flag, args.prefix, clients)
+            if is_execute:
+                logger.info(
+                    f"Executing {flag} deletion with prefix '{args.prefix}'")
+            else:
+                logger.info(
+                    f"Planning to delete {flag} resources with prefix '{args.prefix}'")
+            with profiling.phase(f"{clients.region} {flag} deletion",
+                                 excluding=f"{clients.region} {flag} discovery"):
+                found, failed = func(
+                    args.prefix, logger, is_execute, args.workers, clients)
+            if is_execute and not args.no_cache:
+                invalidate_cache(flag, args.prefix, clients)
+            return ServiceResult(clients.region, flag, found, failed)
+        except DeadlineReached as e:
+            logger.warning(f"Stopped {flag} deletion: {e}")
+            if is_execute and not args.no_cache:
+                invalidate_cache(flag, args.prefix, clients)
+            return ServiceResult(clients.region, flag, e.found, e.failed, undone=e.undone)
+        except Exception as e:
+            logger.error(f"Failed to delete {flag} resources: {e}")
+            return ServiceResult(clients.region, flag, 0, 0, str(e))
+
+    def settle(flag, result):
+        if not is_execute or result.error:
+            return True
+        # Only wait for what this run was handed to delete, e.g. by a plan
+        # or the tagging index, not for anything else under the prefix, and
+        # for deletes a resumed run issued before but never saw finish.
+        deleting = handed_out(clients, flag) | journal.in_state(clients, flag, 'issued')
+        if not deleting:
+            return True
+        logger.info(f"Waiting for {flag} resources to be deleted")
+        list_present = lambda: deleting.intersection(
+            discover(flag, args.prefix, clients, use_cache=False))
+        track = journal.tracker(clients, flag)
+        watch = waiter.track(flag, list_present, logger,
+                             allowed=result.failed + result.undone,
+                             on_gone=track and track.confirmed,
+                             expected=deleting - journal.in_state(clients, flag, 'failed'))
+        with profiling.phase(f"{clients.region} {flag} settle"):
+            return waiter.wait(watch, timeout=deadline.clamp(args.settle_timeout))
+
+    flags = [flag for flag in FUNCTION_MAP if getattr(args, flag)]
+    return run_scheduled(
+        flags, run_service, settle, logger, settle_all=args.wait,
+        not_started=lambda flag: ServiceResult(clients.region, flag, 0, 0, NOT_STARTED))
+
+
+def configure_run(args, is_execute, recorder=None, plan=None):
+    """Configure the shared client settings, deadline and discovery
+    sources of a run."""
+    configure(max_pool_connections=max(DEFAULT_MAX_POOL_CONNECTIONS, args.workers + 1),
+              connect_timeout=args.connect_timeout, read_timeout=args.read_timeout)
+    reserve = 0
+    if args.deadline:
+        reserve = deadline.reserve_for(
+            args.deadline, args.connect_timeout, args.read_timeout)
+    deadline.configure(args.deadline_at, reserve)
+    _handed_out.clear()
+    # Plan runs record what they found; execute runs reuse it while fresh.
+    # An entry that went stale in between is caught by the delete call
+    # itself, which treats not-found as already deleted.
+    inventory_cache.configure(
+        ttl=args.cache_ttl,
+        read=is_execute and not args.no_cache,
+        write=not is_execute and not args.no_cache)
+    plan_file.configure(recorder=recorder, plan=plan)
+    tagging_discovery.configure(
+        enabled=args.discovery == 'tagging',
+        flags=[flag for flag in FUNCTION_MAP if getattr(args, flag)])
+
+
+def run_regions(args, is_execute, logger, waiter, plan=None, credentials=None,
+                handlers=FUNCTION_MAP):
+    """Run the selected handlers in every region of one account."""
+    regions = resolve_regions(args.regions, ClientSet(credentials=credentials))
+    return run_in_regions(
+        client_sets_for(regions, credentials),
+        lambda clients, region_logger: run_region(
+            args, is_execute, clients, region_logger, waiter, plan, handlers),
+        logger)
+
+
+def run_account(role_arn, args, is_execute):
+    """Assume role_arn and run the selected handlers in its account.
+
+    This runs in a pool process of a multi-account run, with its own
+    journal, and returns the account's results and a snapshot of its API
+    call metrics for the parent to aggregate.
+    """
+    account_id = account_of(role_arn)
+    logger = AccountLogger(
+        logging.getLogger('aws_service_deleter'), {'account': account_id})
+    configure_run(args, is_execute)
+    credentials = assume_role(role_arn)
+    run_journal = None
+    if is_execute:
+        run_journal = Journal(account_journal(args.journal, account_id),
+                              str(args.prefix), resume=args.resume)
+    journal.configure(run_journal)
+    with run_journal or nullcontext(), WaiterEngine() as waiter:
+        results = run_regions(args, is_execute, logger, waiter, credentials=credentials)
+    return ([result._replace(account=account_id) for result in results],
+            metrics.snapshot())
+
+
+def run_accounts(args, is_execute, role_arns, log_queue, logger):
+    """Run every account in a process pool and collect their results.
+
+    Pool processes log through log_queue to this process's listener, and
+    their metrics are merged into this process's.
+    """
+    outcomes = run_in_accounts(
+        role_arns, partial(run_account, args=args, is_execute=is_execute),
+        args.account_workers, initializer=forward_logs,
+        initargs=(log_queue, is_execute, bool(args.log_json)))
+    results = []
+    for role_arn, outcome, error in outcomes:
+        account_id = account_of(role_arn)
+        if error is not None:
+            logger.error(f"Failed to clean up account {account_id}: {error}",
+                         extra={'account': account_id, 'error': str(error)})
+            results.append(ServiceResult(None, 'account', 0, 0, str(error), account_id))
+            continue
+        account_results, account_metrics = outcome
+        results.extend(account_results)
+        metrics.merge(account_metrics)
+    return results
+
+
+def open_queue(args):
+    return WorkQueue(args.queue, shared=args.queue_shared,
+                     visibility_timeout=args.visibility_timeout)
+
+
+def run_worker(args, queue, logger):
+    """Lease batches from the work queue and delete them until the queue's
+    coordinator stops its job, or the deadline is near.
+
+    Each batch goes through its service's usual handler, with the batch
+    standing in for the journal: the handler deletes the leased IDs
+    instead of discovering, and its outcomes ack or fail the tasks.
+    """
+    owner = worker_id()
+    prefix = queue.get_meta('prefix')
+    done = failed = 0
+    while not deadline.expired() and not queue.is_stopped():
+        leased = queue.lease(owner)
+        if leased is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+        region, flag, tasks = leased
+        region_logger = RegionLogger(logger, {'region': region})
+        batch = LeasedBatch(queue, owner, tasks)
+        journal.configure(batch)
+        try:
+            with batch:
+                FUNCTION_MAP[flag](prefix, region_logger, True, args.workers,
+                                   ClientSet(region))
+        except DeadlineReached as e:
+            region_logger.warning(f"Stopped {flag} batch: {e}")
+        except Exception as e:
+            region_logger.error(f"Failed to delete {flag} batch: {e}")
+        finally:
+            journal.configure(None)
+        done += batch.done
+        failed += batch.failed
+    logger.info(f"Worker {owner} finished: {done} deleted, {failed} failed attempt(s)")
+
+
+def run_worker_process(args, log_queue):
+    """Body of a local worker process started by the coordinator."""
+    logger = forward_logs(log_queue, True, bool(args.log_json))
+    configure_run(args, True)
+    run_worker(args, open_queue(args), logger)
+
+
+def coordinate(args, queue, log_queue, logger):
+    """Discover the selected services into the work queue and wait for
+    workers to delete them.
+
+    Services are queued in dependency order: a service is only queued
+    once the ones it depends on have been worked off and are gone, so
+    workers never need to know about dependencies. --queue-workers local
+    worker processes are started here; more can join from other
+    processes or hosts with --worker.
+    """
+    def queue_and_wait(flag):
+        def handler(prefix, logger, is_execute, workers, clients):
+            resource_ids = list(discover(flag, prefix, clients))
+            added = queue.put(clients.region, flag, resource_ids)
+            for resource_id in added:
+                logger.debug(f"Queued {flag}: {resource_id}",
+                             extra={'service': flag, 'resource_id': resource_id,
+                                    'action': 'queue'})
+            skipped = len(resource_ids) - len(added)
+            logger.info(
+                f"Queued {len(added)} {flag} resource(s) for deletion"
+                + (f"; {skipped} already in the queue from earlier in this job"
+                   if skipped else ""))
+            counts = queue.wait_for(clients.region, flag, timeout=deadline.remaining())
+            failed = counts.get('failed', 0)
+            undone = counts.get('ready', 0) + counts.get('leased', 0)
+            if undone:
+                # The tasks stay in the queue for the next coordinator.
+                raise DeadlineReached(counts.get('done', 0) + failed + undone, failed, undone)
+            return counts.get('done', 0) + failed, failed
+        return handler
+
+    context = multiprocessing.get_context('spawn')
+    processes = [
+        context.Process(target=run_worker_process, args=(args, log_queue),
+                        name=f"queue-worker-{i}", daemon=True)
+        for i in range(args.queue_workers)
+    ]
+    for process in processes:
+        process.start()
+    results = None
+    try:
+        with WaiterEngine() as waiter:
+            results = run_regions(args, True, logger, waiter, handlers={
+                flag: queue_and_wait(flag) for flag in FUNCTION_MAP})
+        return results
+    finally:
+        # Only a job whose every service was worked off is finished. One
+        # cut short by an interrupt, the deadline or an error keeps its
+        # tasks for the next coordinator; its workers are only stopped.
+        if results is not None and not any(
+                result.error or result.undone for result in results):
+            queue.finish_job()
+        else:
+            queue.stop_job()
+        for process in processes:
+            process.join()
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Delete AWS resources with a given prefix.")
 
-    parser.add_argument('--prefix', type=str, required=True,
-                        help="Prefix for filtering AWS resources.")
+    parser.add_argument('--prefix', action='append',
+                        help="Prefix for filtering AWS resources. Repeat to match several prefixes in one run. Required unless --apply is given.")
+
+    parser.add_argument('--exclude', action='append', default=[],
+                        help="Skip resources matching this prefix even if they match --prefix. Can be repeated.")
 
     for flag in FUNCTION_MAP.keys():
         parser.add_argument(f'--{flag}', action='store_true',
@@ -364,24 +713,218 @@ def main():
     parser.add_argument('--execute', action='store_true',
                         help="Run in execute mode to actually delete the resources. Default is plan mode.")
 
-    args = parser.parse_args()
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f"Maximum concurrent delete calls per service. Default is {DEFAULT_WORKERS}.")
+
+    parser.add_argument('--regions', nargs='+',
+                        help="Regions to clean up, space or comma separated, or 'all' for every enabled region. Default is the profile's region.")
+
+    parser.add_argument('--accounts', nargs='+', metavar='ACCOUNT',
+                        help="Account IDs or role ARNs, space or comma separated, to clean up in parallel processes by assuming a role in each. Default is the profile's own account.")
+
+    parser.add_argument('--role-name', default=DEFAULT_ROLE_NAME,
+                        help=f"Role to assume in accounts given by ID. Default is {DEFAULT_ROLE_NAME}.")
+
+    parser.add_argument('--account-workers', type=int, default=DEFAULT_ACCOUNT_WORKERS,
+                        help=f"Maximum accounts cleaned up at once, one process each. Default is {DEFAULT_ACCOUNT_WORKERS}.")
+
+    parser.add_argument('--wait', action='store_true',
+                        help="In execute mode, wait until every deleted resource is confirmed gone before exiting.")
+
+    parser.add_argument('--discovery', choices=['list', 'tagging'], default='list',
+                        help="How to find resources: 'list' calls each service's own list API, 'tagging' finds tagged resources of every service with one Resource Groups Tagging API listing per region, but misses untagged resources. Default is list.")
+
+    parser.add_argument('--cache-ttl', type=int, default=inventory_cache.DEFAULT_TTL,
+                        help=f"Seconds a plan run's inventory stays valid for a following execute run. Default is {inventory_cache.DEFAULT_TTL}.")
+
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Neither read nor write the local inventory cache.")
+
+    parser.add_argument('--invalidate-cache', action='store_true',
+                        help="Drop cached inventory for the selected services and regions before running.")
+
+    parser.add_argument('--plan-out', metavar='PLAN_FILE',
+                        help="In plan mode, also write the planned deletions to this JSON file.")
 
-    is_execute = args.execute or False
-    logger = get_logger(is_execute)
-
-    for flag, func in FUNCTION_MAP.items():
-        if getattr(args, flag):
-            try:
-                if is_execute:
-                    logger.info(f"Executing {flag} deletion with prefix '{
-                                args.prefix}'")
-                    func(args.prefix, logger, is_execute)
-                else:
-                    logger.info(f"Planning to delete {
-                                flag} resources with prefix '{args.prefix}'")
-                    func(args.prefix, logger, is_execute)
-            except Exception as e:
-                logger.error(f"Failed to delete {flag} resources: {e}")
+    parser.add_argument('--apply', metavar='PLAN_FILE',
+                        help="Execute exactly the deletions in a plan file written by --plan-out, without discovery.")
+
+    parser.add_argument('--log-json', metavar='PATH',
+                        help="Also write every log record, with its service, resource ID, action, outcome and duration, to this file as JSON lines.")
+
+    parser.add_argument('--metrics-json', metavar='PATH',
+                        help="Write per-operation API call metrics (counts, latency histograms, retries, throttles, bytes) to this JSON file.")
+
+    parser.add_argument('--metrics-prom', metavar='PATH',
+                        help="Write the same metrics in Prometheus text format, e.g. for the node exporter's textfile collector.")
+
+    parser.add_argument('--metrics-interval', type=int, default=metrics.DEFAULT_EXPORT_INTERVAL,
+                        help=f"Seconds between metrics file updates during the run; 0 writes them only at the end. Default is {metrics.DEFAULT_EXPORT_INTERVAL}.")
+
+    parser.add_argument('--journal', default=DEFAULT_JOURNAL, metavar='PATH',
+                        help=f"File where execute runs record each resource's progress. Default is {DEFAULT_JOURNAL}.")
+
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue an interrupted execute run from its journal, skipping resources that were already deleted.")
+
+    parser.add_argument('--queue', metavar='PATH',
+                        help="With --execute, put the discovered resources into this SQLite work queue and have worker processes delete them. With --worker, the queue to work on.")
+
+    parser.add_argument('--queue-workers', type=int, default=DEFAULT_LOCAL_WORKERS,
+                        help=f"Worker processes the --queue coordinator starts itself; 0 relies on --worker processes started elsewhere. Default is {DEFAULT_LOCAL_WORKERS}.")
+
+    parser.add_argument('--worker', action='store_true',
+                        help="Delete resources leased from the --queue of a coordinator until it finishes or stops its job. Needs no prefix or resource flags.")
+
+    parser.add_argument('--queue-shared', action='store_true',
+                        help="Use SQLite's rollback journal instead of WAL, for a queue file on shared storage used from several hosts.")
+
+    parser.add_argument('--visibility-timeout', type=int, default=DEFAULT_VISIBILITY_TIMEOUT,
+                        help=f"Seconds a worker's lease lasts without a heartbeat before its tasks go to another worker. Default is {DEFAULT_VISIBILITY_TIMEOUT}.")
+
+    parser.add_argument('--settle-timeout', type=int, default=DEFAULT_SETTLE_TIMEOUT,
+                        help=f"Seconds to wait for a service's resources to be gone before its dependents start. Default is {DEFAULT_SETTLE_TIMEOUT}.")
+
+    parser.add_argument('--deadline', type=int, metavar='SECONDS',
+                        help="Finish the run within this many seconds. New work stops while calls already sent can still complete, and what is left undone is reported; execute runs can finish it with --resume. Default is no limit.")
+
+    parser.add_argument('--connect-timeout', type=int, default=DEFAULT_CONNECT_TIMEOUT,
+                        help=f"Seconds each API call attempt may take to connect. Default is {DEFAULT_CONNECT_TIMEOUT}.")
+
+    parser.add_argument('--read-timeout', type=int, default=DEFAULT_READ_TIMEOUT,
+                        help=f"Seconds each API call attempt may wait for a response. Default is {DEFAULT_READ_TIMEOUT}.")
+
+    parser.add_argument('--profile', metavar='REPORT',
+                        help="Profile the run and write a report of wall time per phase, import time, peak memory with the top allocation sites, and CPU time per function to this file. Slows the run down.")
+
+    args = parser.parse_args()
+    with profiling.profiled(args.profile, 'delete_services'):
+        run(parser, args)
+
+
+def run(parser, args):
+    """Validate the parsed arguments and run the deletions they ask for."""
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.apply and args.plan_out:
+        parser.error("--plan-out cannot be combined with --apply")
+    if args.plan_out and args.execute:
+        parser.error("--plan-out is only available in plan mode")
+    if args.account_workers < 1:
+        parser.error("--account-workers must be at least 1")
+    if args.queue_workers < 0:
+        parser.error("--queue-workers cannot be negative")
+    if args.deadline is not None and args.deadline < 1:
+        parser.error("--deadline must be at least 1")
+    if args.connect_timeout < 1 or args.read_timeout < 1:
+        parser.error("--connect-timeout and --read-timeout must be at least 1")
+    # Absolute, so that the processes this run starts share its deadline.
+    args.deadline_at = time.time() + args.deadline if args.deadline else None
+
+    if args.worker:
+        if not args.queue:
+            parser.error("--worker needs --queue")
+        try:
+            queue = open_queue(args)
+        except sqlite3.Error as e:
+            parser.error(f"Cannot use work queue {args.queue}: {e}")
+        logger = get_logger(True, args.log_json)
+        configure_run(args, True)
+        profiling.mark('startup')
+        with MetricsExporter(args.metrics_json, args.metrics_prom, args.metrics_interval):
+            run_worker(args, queue, logger)
+        metrics.log_summary(logger)
+        return
+
+    role_arns = []
+    if args.accounts:
+        if args.apply or args.plan_out:
+            parser.error("--accounts cannot be combined with --apply or --plan-out")
+        try:
+            role_arns = resolve_accounts(args.accounts, args.role_name)
+        except ValueError as e:
+            parser.error(f"--accounts: {e}")
+    if args.queue:
+        if not args.execute:
+            parser.error("--queue needs --execute, or --worker to work on a queue")
+        if args.apply or role_arns:
+            parser.error("--queue cannot be combined with --apply or --accounts")
+
+    plan = recorder = None
+    if args.apply:
+        try:
+            plan = Plan.load(args.apply)
+        except (OSError, ValueError, KeyError, PlanError) as e:
+            parser.error(f"Cannot read plan file {args.apply}: {e}")
+        args.prefix = plan.prefix
+        args.regions = plan.regions
+        for flag in plan.flags:
+            setattr(args, flag, True)
+    elif not args.prefix:
+        parser.error("--prefix is required unless --apply is given")
+    else:
+        args.prefix = PrefixMatcher(args.prefix, args.exclude)
+        if args.plan_out:
+            recorder = PlanRecorder(args.prefix)
+
+    is_execute = args.execute or plan is not None
+    if args.resume and not is_execute:
+        parser.error("--resume is only available in execute mode")
+    run_journal = queue = None
+    if args.queue:
+        # The work queue is the run's durable record instead of the journal.
+        try:
+            queue = open_queue(args)
+            queue.start_job(str(args.prefix))
+        except (sqlite3.Error, WorkQueueError) as e:
+            parser.error(f"Cannot use work queue {args.queue}: {e}")
+    elif is_execute and not role_arns:
+        try:
+            run_journal = Journal(args.journal, str(args.prefix), resume=args.resume)
+        except (OSError, JournalError) as e:
+            parser.error(f"Cannot use journal {args.journal}: {e}")
+
+    # Pool processes of a multi-account run and local queue workers log
+    # through this process's listener, so its queue has to cross process
+    # boundaries.
+    spawns = role_arns or (queue is not None and args.queue_workers)
+    log_queue = multiprocessing.get_context('spawn').Queue() if spawns else None
+    logger = get_logger(is_execute, args.log_json, log_queue)
+    configure_run(args, is_execute, recorder, plan)
+    journal.configure(run_journal)
+
+    exporter = MetricsExporter(
+        args.metrics_json, args.metrics_prom, args.metrics_interval)
+    profiling.mark('startup')
+    with exporter:
+        if role_arns:
+            results = run_accounts(args, is_execute, role_arns, log_queue, logger)
+        elif queue is not None:
+            results = coordinate(args, queue, log_queue, logger)
+        else:
+            with run_journal or nullcontext(), WaiterEngine() as waiter:
+                results = run_regions(args, is_execute, logger, waiter, plan)
+    log_report(logger, results)
+    metrics.log_summary(logger)
+    stopped = any(result.undone or result.error == NOT_STARTED for result in results)
+    if stopped:
+        hint = ""
+        if queue is not None:
+            hint = "; run again with the same --queue to finish it"
+        elif is_execute:
+            hint = "; run again with --resume to finish it"
+        logger.warning(f"The deadline was reached before all work was done{hint}")
+
+    if recorder is not None:
+        if stopped or not recorder.complete:
+            # A partial plan applied later would silently leave out what
+            # discovery never reached.
+            logger.error(f"Not writing plan to {args.plan_out}: discovery "
+                         f"did not finish, so the plan would be incomplete")
+            return
+        flags = [flag for flag in FUNCTION_MAP if getattr(args, flag)]
+        recorder.write(args.plan_out, dependency_levels(flags))
+        logger.info(f"Wrote plan to {args.plan_out}")
 
 
 if __name__ == "__main__":
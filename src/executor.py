@@ -0,0 +1,28 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_WORKERS = 8
+
+
+def run_in_pool(items, func, workers=DEFAULT_WORKERS):
+    """Call func on each item using a bounded thread pool.
+
+    Yields (item, result, error) tuples in the same order as items, with
+    error set to the exception raised by func or None. At most 2 * workers
+    calls are in flight, so a lazy items iterable is only consumed as fast
+    as calls complete, and one failing call never stops the others.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append((item, pool.submit(func, item)))
+            if len(pending) >= workers * 2:
+                yield _outcome(*pending.popleft())
+        while pending:
+            yield _outcome(*pending.popleft())
+
+
+def _outcome(item, future):
+    error = future.exception()
+    return item, None if error else future.result(), error
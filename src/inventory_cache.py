@@ -0,0 +1,94 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'aws_service_deleter', 'inventory')
+DEFAULT_TTL = 900
+
+logger = logging.getLogger('aws_service_deleter')
+
+_settings = {
+    'directory': DEFAULT_CACHE_DIR,
+    'ttl': DEFAULT_TTL,
+    'read': False,
+    'write': False,
+}
+
+
+def configure(directory=None, ttl=None, read=None, write=None):
+    """Set where the cache lives, how long entries stay fresh, and whether
+    discovery may read from it and write to it."""
+    for name, value in (('directory', directory), ('ttl', ttl),
+                        ('read', read), ('write', write)):
+        if value is not None:
+            _settings[name] = value
+
+
+def _path(account, region, service, prefix):
+    key = json.dumps([account, region, service, str(prefix)])
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    return os.path.join(_settings['directory'], f"{digest}.json")
+
+
+def load(account, region, service, prefix):
+    """Return the cached IDs if a fresh entry exists, else None."""
+    try:
+        with open(_path(account, region, service, prefix)) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    age = time.time() - entry['created_at']
+    if age > _settings['ttl']:
+        return None
+    logger.info(
+        f"Using cached {service} inventory for {region} from {age:.0f}s ago")
+    return entry['ids']
+
+
+def store(account, region, service, prefix, ids):
+    path = _path(account, region, service, prefix)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'created_at': time.time(), 'ids': ids}, f)
+    os.replace(tmp_path, path)
+
+
+def invalidate(account, region, service, prefix):
+    try:
+        os.remove(_path(account, region, service, prefix))
+    except FileNotFoundError:
+        pass
+
+
+def cached(clients, service, prefix, discover):
+    """Yield resource IDs from a fresh cache entry or from discover().
+
+    Entries are keyed by the account and region of clients plus service and
+    prefix. Live results are streamed through unchanged and, when writing
+    is enabled, stored once discovery has run to completion.
+    """
+    if not (_settings['read'] or _settings['write']):
+        yield from discover()
+        return
+
+    key = (clients.account_id, clients.region, service, prefix)
+    if _settings['read']:
+        ids = load(*key)
+        if ids is not None:
+            yield from ids
+            return
+
+    if not _settings['write']:
+        yield from discover()
+        return
+
+    ids = []
+    for resource_id in discover():
+        ids.append(resource_id)
+        yield resource_id
+    store(*key, ids)
@@ -0,0 +1,189 @@
+import json
+import logging
+import os
+import threading
+
+
+DEFAULT_JOURNAL = 'service_deletion.journal'
+# Seconds between fsyncs; records written in between are synced together.
+FSYNC_INTERVAL = 1.0
+# States after which a resource needs no further delete call.
+DONE_STATES = {'issued', 'confirmed'}
+
+logger = logging.getLogger('aws_service_deleter')
+
+
+def account_journal(path, account_id):
+    """Return the journal path of one account in a multi-account run,
+    e.g. service_deletion.123456789012.journal."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{account_id}{ext}"
+
+
+class JournalError(Exception):
+    """Raised for journals that cannot be resumed."""
+
+
+class Journal:
+    """Append-only record of an execute run, one JSON object per line.
+
+    Each resource moves through discovered, issued (the delete call was
+    accepted), confirmed (it is gone) or failed, and a 'listed' record
+    marks a service whose discovery ran to completion. Writes are
+    buffered and fsynced together every FSYNC_INTERVAL seconds and on
+    close; a torn last line left by a crash is ignored when resuming.
+    """
+
+    def __init__(self, path, prefix, resume=False):
+        self.path = path
+        self._states = {}
+        self._listed = set()
+        if resume:
+            self._replay(prefix)
+        self._file = open(path, 'a' if resume else 'w')
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._sync_loop, name='journal-sync', daemon=True)
+        if not resume:
+            self._write({'state': 'run', 'prefix': prefix})
+
+    def _replay(self, prefix):
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        run_prefix = None
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            state = entry.get('state')
+            if state == 'run':
+                run_prefix = entry['prefix']
+            elif state == 'listed':
+                self._listed.add((entry['region'], entry['flag']))
+            elif state is not None:
+                self._states.setdefault(
+                    (entry['region'], entry['flag']), {})[entry['id']] = state
+        if run_prefix != prefix:
+            raise JournalError(
+                f"journal is for prefix '{run_prefix}', not '{prefix}'")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+    def _sync_loop(self):
+        while not self._stopped.wait(FSYNC_INTERVAL):
+            with self._lock:
+                self._sync()
+
+    def _sync(self):
+        # Callers hold _lock.
+        if self._dirty:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._dirty = False
+
+    def _write(self, entry):
+        with self._lock:
+            self._file.write(json.dumps(entry) + '\n')
+            self._dirty = True
+
+    def record(self, region, flag, state, resource_id=None):
+        entry = {'region': region, 'flag': flag, 'state': state}
+        if resource_id is not None:
+            entry['id'] = resource_id
+            with self._lock:
+                self._states.setdefault((region, flag), {})[resource_id] = state
+        self._write(entry)
+
+    def resources(self, region, flag, discover):
+        """Yield the IDs of a service that still need a delete call.
+
+        A service whose listing finished in an earlier run is resumed
+        straight from the journal without calling discover(). Otherwise
+        discover() runs, resources already deleted are skipped, and the
+        rest are recorded as discovered on the way through.
+        """
+        states = self._states.get((region, flag), {})
+        if (region, flag) in self._listed:
+            remaining = [resource_id for resource_id, state in states.items()
+                         if state not in DONE_STATES]
+            logger.info(
+                f"Resuming {flag} in {region} from the journal: "
+                f"{len(states) - len(remaining)} done, {len(remaining)} left")
+            yield from remaining
+            return
+
+        for resource_id in discover():
+            if states.get(resource_id) in DONE_STATES:
+                continue
+            self.record(region, flag, 'discovered', resource_id)
+            yield resource_id
+        self.record(region, flag, 'listed')
+
+    def in_state(self, region, flag, state):
+        """Return the IDs of a service whose latest state is state."""
+        with self._lock:
+            states = dict(self._states.get((region, flag), {}))
+        return {resource_id for resource_id, latest in states.items()
+                if latest == state}
+
+
+class ServiceTracker:
+    """Records delete outcomes of one service in one region."""
+
+    def __init__(self, journal, region, flag):
+        self._journal = journal
+        self._region = region
+        self._flag = flag
+
+    def issued(self, resource_id):
+        self._journal.record(self._region, self._flag, 'issued', resource_id)
+
+    def confirmed(self, resource_id):
+        self._journal.record(self._region, self._flag, 'confirmed', resource_id)
+
+    def failed(self, resource_id):
+        self._journal.record(self._region, self._flag, 'failed', resource_id)
+
+
+_state = {'journal': None}
+
+
+def configure(journal=None):
+    """Record execute runs into journal, or stop journaling with None."""
+    _state['journal'] = journal
+
+
+def journaled(clients, flag, discover):
+    """Return the IDs to delete for a service, through the journal if one
+    is configured (see Journal.resources)."""
+    if _state['journal'] is None:
+        return discover()
+    return _state['journal'].resources(clients.region, flag, discover)
+
+
+def in_state(clients, flag, state):
+    """Return the IDs of a service whose latest state, in this run or one
+    it resumes, is state, e.g. 'issued' for deletions accepted but not yet
+    confirmed; empty when not journaling."""
+    if _state['journal'] is None:
+        return set()
+    return _state['journal'].in_state(clients.region, flag, state)
+
+
+def tracker(clients, flag):
+    """Return a ServiceTracker for the service, or None when not journaling."""
+    if _state['journal'] is None:
+        return None
+    return ServiceTracker(_state['journal'], clients.region, flag)
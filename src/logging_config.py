@@ -1,44 +1,115 @@
+import atexit
+import json
 import logging
-from datetime import datetime
+import queue
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 
 
-class CustomFilter(logging.Filter):
-    def __init__(self, is_execute):
+# Optional fields call sites attach with extra={...}. The JSON lines
+# output includes whichever of them a record has.
+STRUCTURED_FIELDS = (
+    'account', 'region', 'service', 'resource_id', 'action', 'outcome', 'duration', 'error')
+
+
+# Present participles of the verbs call sites pass to action_verb.
+PARTICIPLES = {
+    'delete': 'Deleting',
+    'terminate': 'Terminating',
+    'detach': 'Detaching',
+}
+
+
+def action_verb(verb, is_execute):
+    """Return 'Deleting' for verb 'delete' when executing, and
+    'Planning to delete' in plan mode. verb must be in PARTICIPLES."""
+    if is_execute:
+        return PARTICIPLES[verb]
+    return f"Planning to {verb}"
+
+
+class ModeFilter(logging.Filter):
+    """Labels every record with the run mode, PLAN or EXECUTE."""
+
+    def __init__(self, mode):
         super().__init__()
-        self.is_execute = is_execute
+        self.mode = mode
 
     def filter(self, record):
-        if not self.is_execute and 'Deleting' in record.msg:
-            record.msg = record.msg.replace('Deleting', 'Planning to delete')
-        if not self.is_execute and 'Terminating' in record.msg:
-            record.msg = record.msg.replace(
-                'Terminating', 'Planning to Terminate')
+        record.mode = self.mode
         return True
 
 
-def get_logger(is_execute: bool):
-    if is_execute:
-        format_str = '[EXECUTE] %(levelname)s - %(message)s'
-    else:
-        format_str = '[PLAN] %(levelname)s - %(message)s'
+class JsonLinesFormatter(logging.Formatter):
+    """Formats each record as one JSON object with its structured fields."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'mode': getattr(record, 'mode', None),
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        return json.dumps(entry, default=str)
+
 
-    timestamp = '%Y-%m-%d_%H:%M:%S'
-    date = datetime.now().strftime(timestamp)
+def forward_logs(log_queue, is_execute: bool, verbose=False):
+    """Send this process's log records to log_queue, labelled with the run
+    mode, and return the tool's logger.
 
-    handlers = [
-        logging.StreamHandler()
-    ]
+    get_logger uses this for the listener's own queue; pool processes of
+    a multi-account run call it with the queue of the parent's listener.
+    verbose also passes the tool's DEBUG records.
+    """
+    queue_handler = QueueHandler(log_queue)
+    # The queue only carries the rendered message; the listener's handlers
+    # add the level and mode.
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    queue_handler.addFilter(ModeFilter('EXECUTE' if is_execute else 'PLAN'))
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+
+    logger = logging.getLogger('aws_service_deleter')
+    if verbose:
+        logger.setLevel(logging.DEBUG)
+    return logger
+
+
+def get_logger(is_execute: bool, json_log=None, log_queue=None):
+    """Set up logging for a run and return the tool's logger.
+
+    Records are only put on a queue by the threads that log them; a
+    listener thread formats them and does the console and file I/O, so
+    slow output never holds up deletions. With json_log, every record,
+    including per-resource DEBUG outcomes, is also written to that file
+    as JSON lines. log_queue replaces the default in-process queue, e.g.
+    with a multiprocessing queue that other processes forward to.
+    """
+    text_formatter = logging.Formatter('[%(mode)s] %(levelname)s - %(message)s')
+
+    handlers = [logging.StreamHandler()]
 
     if is_execute:
+        date = datetime.now().strftime('%Y-%m-%d_%H:%M:%S')
         handlers.append(logging.FileHandler(f'{date}_service_deletion.log'))
 
-    logging.basicConfig(
-        level=logging.INFO,
-        format=format_str,
-        handlers=handlers
-    )
+    for handler in handlers:
+        handler.setFormatter(text_formatter)
+        handler.setLevel(logging.INFO)
 
-    logger = logging.getLogger('aws_service_deleter')
-    logger.addFilter(CustomFilter(is_execute))
+    if json_log:
+        json_handler = logging.FileHandler(json_log)
+        json_handler.setFormatter(JsonLinesFormatter())
+        handlers.append(json_handler)
 
-    return logger
+    if log_queue is None:
+        log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    return forward_logs(log_queue, is_execute, verbose=bool(json_log))
@@ -0,0 +1,270 @@
+import json
+import os
+import threading
+import time
+
+from deadline import DeadlineReached
+from rate_limit import THROTTLING_ERRORS
+
+
+# Upper bounds (seconds) of the call latency histogram buckets.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+DEFAULT_EXPORT_INTERVAL = 30
+
+
+class OperationStats:
+    """Counters and latency histogram for one operation in one region."""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency_sum = 0.0
+        self.latency_counts = [0] * len(LATENCY_BUCKETS)
+
+    def observe(self, latency):
+        self.latency_sum += latency
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.latency_counts[i] += 1
+                break
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'throttles': self.throttles,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'latency_seconds_sum': round(self.latency_sum, 6),
+            'latency_buckets': {
+                _bucket_label(bound): count
+                for bound, count in zip(LATENCY_BUCKETS, self.latency_counts)
+            },
+        }
+
+
+def _bucket_label(bound):
+    return '+Inf' if bound == float('inf') else str(bound)
+
+
+_lock = threading.Lock()
+_stats = {}
+
+
+def _get(region, service, operation):
+    # Callers hold _lock.
+    key = (region, service, operation)
+    stats = _stats.get(key)
+    if stats is None:
+        stats = _stats[key] = OperationStats()
+    return stats
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def snapshot():
+    """Return {(region, service, operation): stats dict} for every call so far."""
+    with _lock:
+        return {key: stats.as_dict() for key, stats in _stats.items()}
+
+
+def merge(other):
+    """Add a snapshot() taken in another process, e.g. a pool process of a
+    multi-account run, to this process's metrics."""
+    with _lock:
+        for key, values in other.items():
+            stats = _get(*key)
+            for field in ('calls', 'errors', 'retries', 'throttles',
+                          'bytes_sent', 'bytes_received'):
+                setattr(stats, field, getattr(stats, field) + values[field])
+            stats.latency_sum += values['latency_seconds_sum']
+            for i, count in enumerate(values['latency_buckets'].values()):
+                stats.latency_counts[i] += count
+
+
+def _content_length(http_response):
+    try:
+        return int(http_response.headers.get('content-length', 0))
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
+def attach(client):
+    """Register hooks that record every call made through a client.
+
+    Latency runs from before-call to after-call, so it covers rate
+    limiter waits and botocore's retries as well as the requests
+    themselves. Bytes are counted per attempt.
+    """
+    service = client.meta.service_model.service_name
+    region = client.meta.region_name
+    events = client.meta.events
+
+    def operation_of(event_name):
+        return event_name.rsplit('.', 1)[-1]
+
+    def before_call(context, **kwargs):
+        context['metrics_started'] = time.monotonic()
+
+    def before_send(request, event_name, **kwargs):
+        body = request.body
+        size = len(body) if isinstance(body, (bytes, str)) else 0
+        with _lock:
+            _get(region, service, operation_of(event_name)).bytes_sent += size
+
+    def needs_retry(operation, response=None, **kwargs):
+        if response is None:
+            return
+        http_response, parsed = response
+        throttled = (parsed or {}).get('Error', {}).get('Code') in THROTTLING_ERRORS
+        with _lock:
+            stats = _get(region, service, operation.name)
+            stats.bytes_received += _content_length(http_response)
+            if throttled:
+                stats.throttles += 1
+
+    def record(operation, context, failed):
+        now = time.monotonic()
+        # before-call hooks registered ahead of ours can answer a call and
+        # skip before_call; such calls count with zero latency.
+        latency = now - context.get('metrics_started', now)
+        attempts = context.get('retries', {}).get('attempt', 1)
+        with _lock:
+            stats = _get(region, service, operation)
+            stats.calls += 1
+            stats.retries += attempts - 1
+            if failed:
+                stats.errors += 1
+            stats.observe(latency)
+
+    def after_call(http_response, model, context, **kwargs):
+        record(model.name, context, http_response.status_code >= 300)
+
+    def after_call_error(event_name, context, exception, **kwargs):
+        # Requests the run's deadline refused were never made.
+        if isinstance(exception, DeadlineReached):
+            return
+        record(operation_of(event_name), context, True)
+
+    events.register('before-call', before_call)
+    events.register('before-send', before_send)
+    events.register('needs-retry', needs_retry)
+    events.register('after-call', after_call)
+    events.register('after-call-error', after_call_error)
+
+
+def _write_atomic(path, text):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_json(path):
+    operations = [
+        {'region': region, 'service': service, 'operation': operation, **stats}
+        for (region, service, operation), stats in sorted(snapshot().items())
+    ]
+    _write_atomic(path, json.dumps(
+        {'updated_at': time.time(), 'operations': operations}, indent=2))
+
+
+def _labels(region, service, operation, **extra):
+    labels = {'region': region, 'service': service, 'operation': operation, **extra}
+    return ','.join(f'{name}="{value}"' for name, value in labels.items())
+
+
+COUNTERS = [
+    ('calls', 'api_calls_total', "API calls made."),
+    ('errors', 'api_errors_total', "API calls that failed."),
+    ('retries', 'api_retries_total', "Retried attempts of API calls."),
+    ('throttles', 'api_throttles_total', "Attempts rejected by throttling."),
+    ('bytes_sent', 'api_request_bytes_total', "Request body bytes sent."),
+    ('bytes_received', 'api_response_bytes_total', "Response bytes received."),
+]
+METRIC_PREFIX = 'aws_service_deleter_'
+
+
+def write_prometheus(path):
+    """Write the metrics in Prometheus text format, for the node exporter's
+    textfile collector."""
+    stats = sorted(snapshot().items())
+    lines = []
+    for field, name, help_text in COUNTERS:
+        lines.append(f"# HELP {METRIC_PREFIX}{name} {help_text}")
+        lines.append(f"# TYPE {METRIC_PREFIX}{name} counter")
+        for key, values in stats:
+            lines.append(f"{METRIC_PREFIX}{name}{{{_labels(*key)}}} {values[field]}")
+
+    name = f"{METRIC_PREFIX}api_call_duration_seconds"
+    lines.append(f"# HELP {name} API call latency, including retries.")
+    lines.append(f"# TYPE {name} histogram")
+    for key, values in stats:
+        cumulative = 0
+        for le, count in values['latency_buckets'].items():
+            cumulative += count
+            lines.append(f"{name}_bucket{{{_labels(*key, le=le)}}} {cumulative}")
+        lines.append(f"{name}_sum{{{_labels(*key)}}} {values['latency_seconds_sum']}")
+        lines.append(f"{name}_count{{{_labels(*key)}}} {values['calls']}")
+    _write_atomic(path, '\n'.join(lines) + '\n')
+
+
+class MetricsExporter:
+    """Writes the metrics files on an interval while a run is in progress,
+    and once more on exit."""
+
+    def __init__(self, json_path=None, prometheus_path=None,
+                 interval=DEFAULT_EXPORT_INTERVAL):
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='metrics-exporter', daemon=True)
+
+    def export(self):
+        if self.json_path:
+            write_json(self.json_path)
+        if self.prometheus_path:
+            write_prometheus(self.prometheus_path)
+
+    def __enter__(self):
+        if self.interval and (self.json_path or self.prometheus_path):
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.export()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.export()
+
+
+def log_summary(logger, top=5):
+    """Log total calls and the operations that took the most time."""
+    stats = snapshot()
+    if not stats:
+        return
+    calls = sum(values['calls'] for values in stats.values())
+    retries = sum(values['retries'] for values in stats.values())
+    throttles = sum(values['throttles'] for values in stats.values())
+    logger.info(
+        f"API calls: {calls} ({retries} retries, {throttles} throttled attempts)")
+    slowest = sorted(stats.items(), key=lambda item: item[1]['latency_seconds_sum'],
+                     reverse=True)[:top]
+    for (region, service, operation), values in slowest:
+        logger.info(
+            f"  {region} {service}.{operation}: {values['calls']} calls, "
+            f"{values['latency_seconds_sum']:.1f}s total")
@@ -0,0 +1,120 @@
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+from prefix_filter import PrefixMatcher
+
+
+PLAN_VERSION = 1
+
+
+class PlanError(Exception):
+    """Raised for plan files that cannot be applied."""
+
+
+class PlanRecorder:
+    """Collects the resources a plan run discovers, per region and service."""
+
+    def __init__(self, prefix):
+        self.prefix = PrefixMatcher.of(prefix)
+        self._regions = {}
+        self._unfinished = set()
+        self._lock = threading.Lock()
+
+    def record(self, clients, flag, resource_ids):
+        """Pass resource_ids through while adding each one to the plan."""
+        account = clients.account_id
+        with self._lock:
+            region = self._regions.setdefault(
+                clients.region, {'account': account, 'services': {}})
+            recorded = region['services'].setdefault(flag, [])
+            self._unfinished.add((clients.region, flag))
+        for resource_id in resource_ids:
+            recorded.append(resource_id)
+            yield resource_id
+        with self._lock:
+            self._unfinished.discard((clients.region, flag))
+
+    @property
+    def complete(self):
+        """False if a recorded listing was not read to its end, e.g. because
+        the run's deadline stopped it or the listing failed."""
+        with self._lock:
+            return not self._unfinished
+
+    def write(self, path, order):
+        """Write the plan as JSON; order is the dependency levels of the flags."""
+        plan = {
+            'version': PLAN_VERSION,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'prefixes': self.prefix.prefixes,
+            'excludes': self.prefix.excludes,
+            'order': order,
+            'regions': self._regions,
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(plan, f, indent=2)
+        os.replace(tmp_path, path)
+
+
+class Plan:
+    """A plan file loaded for --apply."""
+
+    def __init__(self, data):
+        if data.get('version') != PLAN_VERSION:
+            raise PlanError(
+                f"Unsupported plan version {data.get('version')!r}")
+        self.prefix = PrefixMatcher(data['prefixes'], data['excludes'])
+        self.order = data['order']
+        self._regions = data['regions']
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    @property
+    def regions(self):
+        return list(self._regions)
+
+    @property
+    def flags(self):
+        return [flag for level in self.order for flag in level]
+
+    def check_account(self, clients):
+        if clients.region not in self._regions:
+            raise PlanError(f"Plan has no resources in {clients.region}")
+        expected = self._regions[clients.region]['account']
+        if clients.account_id != expected:
+            raise PlanError(
+                f"Plan was made for account {expected} but the current "
+                f"credentials belong to {clients.account_id}")
+
+    def resource_ids(self, region, flag):
+        return list(self._regions.get(region, {}).get('services', {}).get(flag, []))
+
+
+_state = {'recorder': None, 'plan': None}
+
+
+def configure(recorder=None, plan=None):
+    """Record discovery into recorder, or take resources from plan instead."""
+    _state['recorder'] = recorder
+    _state['plan'] = plan
+
+
+def planned(clients, flag, discover):
+    """Return the IDs to act on for one service in one region.
+
+    While applying a plan these come straight from the plan and discover
+    is never called. Otherwise discover() runs, and while recording its
+    results are added to the plan as they stream past.
+    """
+    if _state['plan'] is not None:
+        return iter(_state['plan'].resource_ids(clients.region, flag))
+    resource_ids = discover()
+    if _state['recorder'] is not None:
+        return _state['recorder'].record(clients, flag, resource_ids)
+    return resource_ids
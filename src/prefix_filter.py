@@ -1,40 +1,218 @@
-def get_resources_with_prefix(client, prefix, resource_key, identifier_key, service_type, method):
+import re
+
+
+# EC2 filters that narrow a describe call to resources whose value starts
+# with the prefix. Each filter name is sent as its own query and the results
+# are merged, since filters within one call are ANDed together.
+SERVER_SIDE_FILTERS = {
+    'ec2': ['tag:Name'],
+    'vpc': ['tag:Name'],
+    'security_group': ['group-name', 'tag:Name'],
+}
+
+# Filters added to every query for a service. Terminated instances stay
+# visible for about an hour but there is nothing left to delete, so they
+# are skipped; this also lets "no instances found" mean they are all gone.
+STATE_FILTERS = {
+    'ec2': [{'Name': 'instance-state-name',
+             'Values': ['pending', 'running', 'shutting-down', 'stopping', 'stopped']}],
+}
+
+
+class PrefixMatcher:
+    """Matches names against any number of prefixes.
+
+    All prefixes are compiled into one regular expression, which tries
+    them in turn, so one listing per service serves every prefix. Names
+    that match one of the excludes are never matched.
+    """
+
+    def __init__(self, prefixes, excludes=()):
+        self.prefixes = sorted(set(prefixes))
+        self.excludes = sorted(set(excludes))
+        self._include = self._compile(self.prefixes)
+        self._exclude = self._compile(self.excludes) if self.excludes else None
+
+    @staticmethod
+    def _compile(values):
+        return re.compile('|'.join(re.escape(v) for v in values))
+
+    @classmethod
+    def of(cls, prefix):
+        """Return prefix as a matcher, wrapping a plain string."""
+        return prefix if isinstance(prefix, cls) else cls([prefix])
+
+    def startswith(self, value):
+        """True if value starts with a prefix and with no exclude."""
+        return (self._include.match(value) is not None
+                and not (self._exclude and self._exclude.match(value)))
+
+    def contains(self, value):
+        """True if value contains a prefix and no exclude."""
+        return (self._include.search(value) is not None
+                and not (self._exclude and self._exclude.search(value)))
+
+    def mentions(self, value):
+        """True if value contains a prefix, whatever the excludes. Anything
+        startswith() or contains() accepts is accepted here too."""
+        return self._include.search(value) is not None
+
+    def __str__(self):
+        text = ', '.join(self.prefixes)
+        if self.excludes:
+            text += f" (excluding {', '.join(self.excludes)})"
+        return text
+
+
+# Buckets whose location constraint is not their region's name.
+_BUCKET_LOCATIONS = {None: 'us-east-1', '': 'us-east-1', 'EU': 'eu-west-1'}
+
+
+def _bucket_region(client, item):
+    region = item.get('BucketRegion')
+    if region is None:
+        location = client.get_bucket_location(Bucket=item['Name']).get('LocationConstraint')
+        region = _BUCKET_LOCATIONS.get(location, location)
+    return region
+
+
+def _filter_queries(service_type, matcher):
+    filter_names = SERVER_SIDE_FILTERS.get(service_type)
+    if not filter_names:
+        return [{}]
+    # '*' and '?' are wildcards in EC2 filter values; escape them so they
+    # match literally, then append '*' to turn the value into a prefix match.
+    # Values within one filter are ORed, so every prefix shares a query.
+    patterns = [
+        prefix.replace('\\', '\\\\').replace('*', '\\*').replace('?', '\\?') + '*'
+        for prefix in matcher.prefixes
+    ]
+    return [
+        {'Filters': [{'Name': name, 'Values': patterns}] + STATE_FILTERS.get(service_type, [])}
+        for name in filter_names
+    ]
+
+
+def iter_pages(client, method, **kwargs):
+    """Yield every response page of a list/describe call, one at a time."""
+    if client.can_paginate(method):
+        yield from client.get_paginator(method).paginate(**kwargs)
+    else:
+        yield getattr(client, method)(**kwargs)
+
+
+def _iter_items(page, resource_key, service_type):
     if service_type == 'ec2':
-        resources = client.describe_instances()
-        items = []
-        for reservation in resources[resource_key]:
-            items.extend(reservation['Instances'])
+        for reservation in page.get(resource_key, []):
+            yield from reservation['Instances']
     else:
-        method_to_call = getattr(client, method)
-        resources = method_to_call()
-        items = resources[resource_key]
+        yield from page.get(resource_key, [])
 
-    resource_ids = []
 
+def matched_name(item, matcher, identifier_key, service_type):
+    """Return the name an item matched the prefix on, or None."""
     if service_type == 'ecs':
-        resource_ids = [
-            item for item in items if item.split('/')[-1].startswith(prefix)
-        ]
-    elif service_type == 'amplify':
-        resource_ids = [
-            item[identifier_key]
-            for item in items
-            if item['name'].startswith(prefix)
-        ]
-    elif service_type in ['ec2', 'vpc', 'security_group']:
-        for item in items:
-            if 'GroupName' in item:
-                if item['GroupName'].startswith(prefix):
-                    resource_ids.append(item[identifier_key])
-            if 'Tags' in item:
-                for tag in item['Tags']:
-                    if tag['Key'] == 'Name' and tag['Value'].startswith(prefix):
-                        resource_ids.append(item[identifier_key])
-    else:
-        resource_ids = [
-            item[identifier_key]
-            for item in items
-            if prefix in item[identifier_key]
-        ]
+        name = item.split('/')[-1]
+        return name if matcher.startswith(name) else None
+    if service_type == 'amplify':
+        return item['name'] if matcher.startswith(item['name']) else None
+    if service_type in ['ec2', 'vpc', 'security_group']:
+        group_name = item.get('GroupName', '')
+        if matcher.startswith(group_name):
+            return group_name
+        for tag in item.get('Tags', []):
+            if tag['Key'] == 'Name' and matcher.startswith(tag['Value']):
+                return tag['Value']
+        return None
+    return item[identifier_key] if matcher.contains(item[identifier_key]) else None
+
+
+def matching_id(item, matcher, identifier_key, service_type):
+    if matched_name(item, matcher, identifier_key, service_type) is None:
+        return None
+    return item if service_type == 'ecs' else item[identifier_key]
+
+
+class Resource:
+    """A matching resource, as discovery keeps it.
+
+    Only what identifies the resource is kept, so a listing can be
+    dropped as soon as its matches are taken out of it.
+    """
+
+    __slots__ = ('id', 'service', 'region', 'name')
+
+    def __init__(self, id, service, region, name):
+        self.id = id
+        self.service = service
+        self.region = region
+        self.name = name
+
+    def __repr__(self):
+        return f"Resource({self.id!r}, {self.service!r}, {self.region!r}, {self.name!r})"
+
 
-    return resource_ids
+def project(item, matcher, identifier_key, service_type, region):
+    """Return a Resource for item if it matches, else None."""
+    name = matched_name(item, matcher, identifier_key, service_type)
+    if name is None:
+        return None
+    resource_id = item if service_type == 'ecs' else item[identifier_key]
+    return Resource(resource_id, service_type, region, name)
+
+
+def _project_page(client, page, matcher, resource_key, identifier_key,
+                  service_type, region):
+    """Return the Resources of one page's matching items."""
+    resources = []
+    for item in _iter_items(page, resource_key, service_type):
+        resource = project(item, matcher, identifier_key, service_type, region)
+        if resource is None:
+            continue
+        if service_type == 's3' and _bucket_region(client, item) != region:
+            continue
+        resources.append(resource)
+    return resources
+
+
+def get_resources(client, prefix, resource_key, identifier_key, service_type, method):
+    """Yield a Resource for every matching resource, page by page.
+
+    Pages are fetched lazily, so callers can start deleting the first
+    matches while later pages are still to come. Only the Resources a
+    page matches are kept; the raw page itself stays alive, held by the
+    paginator, until the next one is fetched, so memory grows with the
+    matches and one page rather than with the account. Where the
+    API supports it the prefix is also sent as a server-side filter; the
+    local match still runs on every item so APIs without filters behave
+    as before. prefix is a string or a PrefixMatcher covering several
+    prefixes and excludes.
+    """
+    if service_type == 'ec2':
+        method = 'describe_instances'
+
+    matcher = PrefixMatcher.of(prefix)
+    region = client.meta.region_name
+    queries = _filter_queries(service_type, matcher)
+    if service_type == 's3':
+        # list_buckets returns the buckets of every region; only this
+        # region's belong to this region's run.
+        queries = [{**query, 'BucketRegion': region} for query in queries]
+    seen = set() if len(queries) > 1 else None
+
+    for query in queries:
+        for page in iter_pages(client, method, **query):
+            for resource in _project_page(client, page, matcher, resource_key,
+                                          identifier_key, service_type, region):
+                if seen is not None:
+                    if resource.id in seen:
+                        continue
+                    seen.add(resource.id)
+                yield resource
+
+
+def get_resources_with_prefix(client, prefix, resource_key, identifier_key, service_type, method):
+    """Yield the IDs of matching resources page by page (see get_resources)."""
+    for resource in get_resources(client, prefix, resource_key, identifier_key,
+                                  service_type, method):
+        yield resource.id
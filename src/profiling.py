@@ -0,0 +1,198 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+
+# Entries listed in each section of the report.
+TOP_FUNCTIONS = 40
+TOP_IMPORTS = 25
+TOP_ALLOCATIONS = 15
+# From 3.12 cProfile hooks into sys.monitoring, which sees every thread of
+# the interpreter and allows only one profiler at a time. Before that a
+# profiler sees only the thread that enabled it.
+PROFILES_ALL_THREADS = sys.version_info >= (3, 12)
+
+logger = logging.getLogger('aws_service_deleter')
+
+_lock = threading.Lock()
+_settings = {'enabled': False, 'started': None}
+_phases = {}
+_profiles = []
+
+
+def _add(name, seconds):
+    with _lock:
+        _phases[name] = _phases.get(name, 0.0) + seconds
+
+
+def _elapsed(name):
+    with _lock:
+        return _phases.get(name, 0.0)
+
+
+@contextmanager
+def phase(name, excluding=None):
+    """Add the wall time of the block to phase name.
+
+    Time added to the phase excluding while the block runs is taken off,
+    so e.g. deletion can leave out the discovery its lazy listing does.
+    Does nothing unless a profiled() run is in progress.
+    """
+    if not _settings['enabled']:
+        yield
+        return
+    started = time.perf_counter()
+    excluded = _elapsed(excluding)
+    try:
+        yield
+    finally:
+        _add(name, time.perf_counter() - started - (_elapsed(excluding) - excluded))
+
+
+def timed(name, iterable):
+    """Return iterable, adding the time spent fetching each item to phase
+    name while a profiled() run is in progress."""
+    if not _settings['enabled']:
+        return iterable
+
+    def items():
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                _add(name, time.perf_counter() - started)
+            yield item
+
+    return items()
+
+
+def mark(name):
+    """Record the time from the start of the profiled() run as phase name."""
+    if _settings['enabled']:
+        _add(name, time.perf_counter() - _settings['started'])
+
+
+def _profile_thread(frame, event, arg):
+    # Installed with threading.setprofile where a profiler only sees its
+    # own thread: the first event in every new thread swaps this function
+    # for a profiler of the thread's own.
+    profile = cProfile.Profile()
+    with _lock:
+        _profiles.append(profile)
+    profile.enable()
+
+
+def import_times(module, cwd):
+    """Import module in a fresh interpreter with -X importtime and return
+    [(cumulative_us, self_us, name)], slowest first."""
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    times = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            continue  # the header line
+        times.append((cumulative_us, self_us, fields[2].strip()))
+    return sorted(times, reverse=True)
+
+
+def _format_report(module, wall_time, stats, peak, snapshot, imports):
+    out = io.StringIO()
+    out.write(f"Profile of {module}, {datetime.now().isoformat(timespec='seconds')}\n")
+    out.write(f"Wall time: {wall_time:.3f}s\n\n")
+
+    out.write("Phases (wall seconds):\n")
+    width = max((len(name) for name in _phases), default=0)
+    for name, seconds in _phases.items():
+        out.write(f"  {name:<{width}}  {seconds:10.3f}\n")
+
+    out.write(f"\nImport time of {module} in a fresh interpreter "
+              f"(top {TOP_IMPORTS} by cumulative ms):\n")
+    for cumulative_us, self_us, name in imports[:TOP_IMPORTS]:
+        out.write(f"  {cumulative_us / 1000:10.1f} {self_us / 1000:10.1f}  {name}\n")
+
+    out.write(f"\nMemory: peak {peak / 2**20:.1f} MiB traced\n")
+    out.write(f"Top {TOP_ALLOCATIONS} allocation sites still held at the end:\n")
+    for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+        frame = stat.traceback[0]
+        out.write(f"  {stat.size / 1024:10.1f} KiB {stat.count:8d} blocks  "
+                  f"{frame.filename}:{frame.lineno}\n")
+
+    out.write(f"\nCPU, all threads (top {TOP_FUNCTIONS} by cumulative time):\n")
+    stats.stream = out
+    stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+    return out.getvalue()
+
+
+@contextmanager
+def profiled(path, module):
+    """Profile the block and write a report to path; with no path, just
+    run the block.
+
+    The report has the wall time of every phase recorded with phase(),
+    timed() and mark(), the import time of module, the peak traced memory
+    with the allocation sites still held at the end, and cProfile stats
+    summed over every thread started in the block. The raw stats are
+    also saved to path + '.pstats'. Tracing memory slows the run down
+    considerably, so the phase times are only comparable between
+    profiled runs. Pool processes of multi-account runs are not profiled.
+    """
+    if not path:
+        yield
+        return
+
+    with _lock:
+        _phases.clear()
+        _profiles.clear()
+    _settings.update(enabled=True, started=time.perf_counter())
+    tracemalloc.start()
+    if not PROFILES_ALL_THREADS:
+        threading.setprofile(_profile_thread)
+    main_profile = cProfile.Profile()
+    main_profile.enable()
+    try:
+        yield
+    finally:
+        main_profile.disable()
+        if not PROFILES_ALL_THREADS:
+            threading.setprofile(None)
+        wall_time = time.perf_counter() - _settings['started']
+        _settings['enabled'] = False
+        peak = tracemalloc.get_traced_memory()[1]
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+        ])
+        tracemalloc.stop()
+
+        stats = pstats.Stats(main_profile)
+        with _lock:
+            profiles = list(_profiles)
+        for profile in profiles:
+            stats.add(profile)
+        stats.dump_stats(f"{path}.pstats")
+
+        source_dir = os.path.dirname(os.path.abspath(__file__))
+        report = _format_report(module, wall_time, stats, peak, snapshot,
+                                import_times(module, source_dir))
+        with open(path, 'w') as f:
+            f.write(report)
+        logger.info(f"Wrote profile to {path}")
@@ -0,0 +1,192 @@
+import threading
+import time
+
+from deadline import DeadlineReached
+
+
+THROTTLING_ERRORS = {
+    'Throttling', 'ThrottlingException', 'ThrottledException',
+    'RequestLimitExceeded', 'RequestThrottled', 'RequestThrottledException',
+    'TooManyRequestsException', 'SlowDown', 'EC2ThrottledException',
+    'ProvisionedThroughputExceededException', 'BandwidthLimitExceeded',
+    'PriorRequestNotComplete',
+}
+
+# Starting request rate (per second) for each service in one region. The
+# rate then adapts: it grows slowly while calls succeed and halves on every
+# throttling response.
+INITIAL_RATES = {
+    'ec2': 20,
+    'elasticloadbalancing': 10,
+}
+DEFAULT_INITIAL_RATE = 10
+MIN_RATE = 0.5
+MAX_RATE = 100
+RATE_INCREASE = 0.5
+RATE_DECREASE = 0.5
+
+DEFAULT_FAILURE_THRESHOLD = 20
+DEFAULT_RESET_TIMEOUT = 60
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service that keeps failing."""
+
+
+class AdaptiveRateLimiter:
+    """Token bucket whose refill rate follows AIMD control.
+
+    acquire() blocks until a token is available. on_success() adds
+    RATE_INCREASE / rate to the rate, so calls succeeding at the full rate
+    raise it by RATE_INCREASE per second however fast it already is, and
+    on_throttle() multiplies it by RATE_DECREASE, so the rate hovers just
+    under the service's limit.
+    """
+
+    def __init__(self, rate=DEFAULT_INITIAL_RATE, min_rate=MIN_RATE, max_rate=MAX_RATE):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        capacity = max(self.rate, 1)
+        self._tokens = min(
+            capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE / self.rate)
+
+    def on_throttle(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * RATE_DECREASE)
+            self._tokens = min(self._tokens, 0)
+
+
+class CircuitBreaker:
+    """Stops calls to a service after too many consecutive failures.
+
+    Once open, calls fail fast with CircuitOpenError until reset_timeout
+    has passed; then one trial call is let through, closing the circuit
+    again if it succeeds.
+    """
+
+    def __init__(self, name, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if (time.monotonic() - self._opened_at < self.reset_timeout
+                    or self._trial_running):
+                raise CircuitOpenError(
+                    f"{self.name} is failing repeatedly; not calling it for now")
+            self._trial_running = True
+
+    def record(self, success):
+        with self._lock:
+            self._trial_running = False
+            if success:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    def cancel(self):
+        """Forget a call that was let through but never sent."""
+        with self._lock:
+            self._trial_running = False
+
+
+class ServiceLimits:
+    """Rate limiter and circuit breaker shared by one service in one region."""
+
+    def __init__(self, service, region):
+        self.limiter = AdaptiveRateLimiter(
+            INITIAL_RATES.get(service, DEFAULT_INITIAL_RATE))
+        self.breaker = CircuitBreaker(f"{service} in {region}")
+
+
+_lock = threading.Lock()
+_limits = {}
+
+
+def get_limits(service, region, credentials=None):
+    key = (service, region, credentials)
+    with _lock:
+        if key not in _limits:
+            _limits[key] = ServiceLimits(service, region)
+        return _limits[key]
+
+
+def _error_code(parsed):
+    return (parsed or {}).get('Error', {}).get('Code')
+
+
+def attach(client, credentials=None):
+    """Register rate limiting and circuit breaking hooks on a client.
+
+    Every HTTP attempt, retries included, takes a token from the service's
+    bucket. botocore's own retry handler does the retrying; the
+    needs-retry hook only feeds each attempt's outcome back into the rate.
+    """
+    service = client.meta.service_model.endpoint_prefix
+    limits = get_limits(service, client.meta.region_name, credentials)
+    events = client.meta.events
+
+    def before_call(**kwargs):
+        limits.breaker.before_call()
+
+    def before_send(**kwargs):
+        limits.limiter.acquire()
+
+    def needs_retry(response=None, **kwargs):
+        if response is None:
+            return
+        http_response, parsed = response
+        if _error_code(parsed) in THROTTLING_ERRORS:
+            limits.limiter.on_throttle()
+        elif http_response.status_code < 300:
+            limits.limiter.on_success()
+
+    def after_call(http_response, parsed, **kwargs):
+        failed = (http_response.status_code >= 500
+                  or _error_code(parsed) in THROTTLING_ERRORS)
+        limits.breaker.record(not failed)
+
+    def after_call_error(exception, **kwargs):
+        # Requests the run's deadline refused never reached the service.
+        if isinstance(exception, DeadlineReached):
+            limits.breaker.cancel()
+            return
+        limits.breaker.record(False)
+
+    events.register('before-call', before_call)
+    events.register('before-send', before_send)
+    events.register('needs-retry', needs_retry)
+    events.register('after-call', after_call)
+    events.register('after-call-error', after_call_error)
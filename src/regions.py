@@ -0,0 +1,61 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from aws_clients import DEFAULT_CLIENTS, ClientSet
+
+
+class RegionLogger(logging.LoggerAdapter):
+    """Prefixes every message with the region it belongs to and adds the
+    region to the record's structured fields."""
+
+    def process(self, msg, kwargs):
+        kwargs['extra'] = {**self.extra, **kwargs.get('extra', {})}
+        return f"[{self.extra['region']}] {msg}", kwargs
+
+
+def resolve_regions(region_args, clients=DEFAULT_CLIENTS):
+    """Turn --regions values into a list of region names.
+
+    Values may be space or comma separated. 'all' expands to every region
+    enabled for the account of clients. No values means the profile's
+    default region.
+    """
+    if not region_args:
+        return [DEFAULT_CLIENTS.region]
+
+    regions = []
+    for value in region_args:
+        regions.extend(name.strip() for name in value.split(',') if name.strip())
+
+    if 'all' in regions:
+        response = clients.ec2.describe_regions()
+        return sorted(region['RegionName'] for region in response['Regions'])
+
+    return list(dict.fromkeys(regions))
+
+
+def client_sets_for(regions, credentials=None):
+    """Build a lazy ClientSet per region, for credentials if given."""
+    return [ClientSet(region, credentials) for region in regions]
+
+
+def run_in_regions(client_sets, func, logger):
+    """Call func(clients, logger) for every region concurrently.
+
+    Each region runs on its own thread with its own clients, so the
+    per-service worker pools started inside func are budgeted per region.
+    func returns a list of results; the lists are concatenated.
+    """
+    if len(client_sets) == 1:
+        return func(client_sets[0], logger)
+
+    with ThreadPoolExecutor(max_workers=len(client_sets)) as pool:
+        futures = [
+            pool.submit(func, clients, RegionLogger(
+                logger, {'region': clients.region}))
+            for clients in client_sets
+        ]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
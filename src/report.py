@@ -0,0 +1,46 @@
+from collections import namedtuple
+
+
+ServiceResult = namedtuple(
+    'ServiceResult', ['region', 'service', 'found', 'failed', 'error', 'account', 'undone'],
+    defaults=[None, None, 0])
+
+
+def log_report(logger, results):
+    """Log one line per account, region and service, then the totals.
+
+    Results of a multi-account run also get a total per account.
+    """
+    results = list(results)
+    if not results:
+        return
+
+    logger.info("Summary:")
+    for result in sorted(results, key=lambda r: (r.account or '', r.region or '', r.service)):
+        where = ' '.join(filter(None, (result.account, result.region, result.service)))
+        if result.error:
+            logger.info(f"  {where}: error - {result.error}")
+        else:
+            text = f"{result.found} found, {result.failed} failed"
+            if result.undone:
+                text += f", {result.undone} left undone at the deadline"
+            logger.info(f"  {where}: {text}")
+
+    accounts = sorted({result.account for result in results if result.account})
+    if len(accounts) > 1:
+        for account in accounts:
+            _log_total(logger, f"  {account} total",
+                       [result for result in results if result.account == account])
+
+    _log_total(logger, "Total", results)
+
+
+def _log_total(logger, label, results):
+    found = sum(result.found for result in results)
+    failed = sum(result.failed for result in results)
+    errors = sum(1 for result in results if result.error)
+    undone = sum(result.undone for result in results)
+    text = f"{label}: {found} found, {failed} failed, {errors} service error(s)"
+    if undone:
+        text += f", {undone} left undone at the deadline"
+    logger.info(text)
@@ -0,0 +1,132 @@
+import threading
+import time
+
+import deadline
+from batching import chunked
+from deadline import DeadlineReached
+from executor import DEFAULT_WORKERS, run_in_pool
+from prefix_filter import iter_pages
+
+
+# delete_objects accepts at most 1,000 keys per request.
+DELETE_OBJECTS_LIMIT = 1000
+PROGRESS_INTERVAL = 10
+
+
+class _Progress:
+    """Thread-safe deleted-object counter that logs throughput periodically."""
+
+    def __init__(self, bucket, logger):
+        self.bucket = bucket
+        self.logger = logger
+        self.deleted = 0
+        self.failed = 0
+        self._started = time.monotonic()
+        self._last_report = self._started
+        self._lock = threading.Lock()
+
+    def add(self, deleted, failed):
+        with self._lock:
+            self.deleted += deleted
+            self.failed += failed
+            now = time.monotonic()
+            if now - self._last_report < PROGRESS_INTERVAL:
+                return
+            self._last_report = now
+            deleted = self.deleted
+        self.logger.info(
+            f"Emptying S3 bucket {self.bucket}: {deleted} objects deleted "
+            f"({self.rate():.0f} objects/s)")
+
+    def rate(self):
+        elapsed = time.monotonic() - self._started
+        return self.deleted / elapsed if elapsed > 0 else 0.0
+
+
+def _iter_versions(s3, bucket, **kwargs):
+    """Yield {'Key', 'VersionId'} for every object version and delete marker.
+
+    Unversioned buckets report each object with VersionId 'null', which
+    delete_objects accepts, so one path covers both kinds of bucket.
+    """
+    for page in iter_pages(s3, 'list_object_versions', Bucket=bucket, **kwargs):
+        for entry in page.get('Versions', []) + page.get('DeleteMarkers', []):
+            yield {'Key': entry['Key'], 'VersionId': entry['VersionId']}
+
+
+def _delete_batch(s3, bucket, objects, progress):
+    deadline.check()
+    response = s3.delete_objects(
+        Bucket=bucket, Delete={'Objects': objects, 'Quiet': True})
+    errors = response.get('Errors', [])
+    for error in errors:
+        progress.logger.error(
+            f"Failed to delete s3://{bucket}/{error['Key']} "
+            f"(version {error.get('VersionId')}) - {error.get('Code')}: {error.get('Message')}")
+    progress.add(len(objects) - len(errors), len(errors))
+
+
+def _empty_partition(s3, bucket, prefix, progress):
+    for objects in chunked(_iter_versions(s3, bucket, Prefix=prefix), DELETE_OBJECTS_LIMIT):
+        _delete_batch(s3, bucket, objects, progress)
+
+
+def _iter_work(s3, bucket):
+    """Yield units of work that together cover the whole bucket.
+
+    A listing with Delimiter='/' yields each top-level key prefix as its
+    own partition, while top-level objects are yielded directly in batches
+    of up to 1,000 keys.
+    """
+    root_objects = []
+    for page in iter_pages(s3, 'list_object_versions', Bucket=bucket, Delimiter='/'):
+        for entry in page.get('Versions', []) + page.get('DeleteMarkers', []):
+            root_objects.append(
+                {'Key': entry['Key'], 'VersionId': entry['VersionId']})
+            if len(root_objects) == DELETE_OBJECTS_LIMIT:
+                yield root_objects
+                root_objects = []
+        for common_prefix in page.get('CommonPrefixes', []):
+            yield common_prefix['Prefix']
+    if root_objects:
+        yield root_objects
+
+
+def empty_bucket(s3, bucket, logger, workers=DEFAULT_WORKERS):
+    """Delete every object version and delete marker in a bucket.
+
+    Keys are split by their first '/' separated segment and the resulting
+    partitions are emptied in parallel, each streaming list_object_versions
+    pages into delete_objects calls of up to 1,000 keys. Memory stays
+    bounded by the few pages and batches in flight. Returns (deleted,
+    failed) object counts, or raises DeadlineReached if the run's
+    deadline stopped it part way.
+    """
+    progress = _Progress(bucket, logger)
+
+    def run(work):
+        if isinstance(work, str):
+            _empty_partition(s3, bucket, work, progress)
+        else:
+            _delete_batch(s3, bucket, work, progress)
+
+    stopped = False
+    for work, _, error in run_in_pool(_iter_work(s3, bucket), run, workers):
+        if isinstance(error, DeadlineReached):
+            stopped = True
+        elif error is not None:
+            where = work if isinstance(work, str) else f"{len(work)} top-level keys"
+            logger.error(f"Failed to empty s3://{bucket}/ ({where}) - {error}")
+
+    if progress.deleted or progress.failed:
+        logger.info(
+            f"Emptied S3 bucket {bucket}: {progress.deleted} objects deleted, "
+            f"{progress.failed} failed ({progress.rate():.0f} objects/s)")
+    if stopped:
+        raise DeadlineReached()
+    return progress.deleted, progress.failed
+
+
+def empty_and_delete_bucket(s3, bucket, logger, workers=DEFAULT_WORKERS):
+    empty_bucket(s3, bucket, logger, workers)
+    s3.delete_bucket(Bucket=bucket)
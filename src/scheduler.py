@@ -0,0 +1,76 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import deadline
+
+
+# Service flag -> flags whose resources must be gone before it can be
+# deleted. Load balancers hold target groups through their listeners; the
+# ENIs of instances, load balancers, caches, databases and VPC Lambdas hold
+# security groups; and all of those plus the security groups sit in VPCs.
+DEPENDENCIES = {
+    'tg': {'elbv2'},
+    'sg': {'ec2', 'elbv2', 'elasticache', 'rds', 'redshift', 'lambda', 'ecs'},
+    'vpc': {'ec2', 'elbv2', 'elasticache', 'rds', 'redshift', 'lambda', 'ecs', 'sg'},
+}
+
+DEFAULT_SETTLE_TIMEOUT = 1800
+
+
+def dependency_levels(flags):
+    """Group flags into levels that can each run once the previous ones are done."""
+    selected = set(flags)
+    remaining = list(flags)
+    done = set()
+    levels = []
+    while remaining:
+        level = [f for f in remaining
+                 if DEPENDENCIES.get(f, set()) & selected <= done]
+        levels.append(level)
+        done.update(level)
+        remaining = [f for f in remaining if f not in done]
+    return levels
+
+
+def run_scheduled(flags, run_service, settle, logger, settle_all=False,
+                  not_started=None):
+    """Run run_service(flag) for every flag in dependency order.
+
+    Services with no unfinished prerequisites among flags run in parallel.
+    When a service that others depend on returns, settle(flag, result) is
+    called to block until its resources are actually gone before any
+    dependent starts; with settle_all, every service is settled before the
+    run ends. Once the run's deadline is near (see deadline.configure),
+    services not yet started are skipped and not_started(flag) stands in
+    for their results. Returns the results in flags order.
+    """
+    flags = list(flags)
+    selected = set(flags)
+    prerequisites = {
+        flag: DEPENDENCIES.get(flag, set()) & selected for flag in flags}
+    needed_by_others = set().union(*prerequisites.values())
+
+    def task(flag):
+        result = run_service(flag)
+        if settle_all or flag in needed_by_others:
+            if not settle(flag, result):
+                logger.warning(
+                    f"Timed out waiting for {flag} resources to be deleted")
+        return result
+
+    results = {}
+    pending = list(flags)
+    with ThreadPoolExecutor(max_workers=max(len(flags), 1)) as pool:
+        running = {}
+        while pending or running:
+            for flag in [f for f in pending if prerequisites[f] <= results.keys()]:
+                pending.remove(flag)
+                if not_started is not None and deadline.expired():
+                    logger.warning(f"Not starting {flag}: the deadline is near")
+                    results[flag] = not_started(flag)
+                else:
+                    running[pool.submit(task, flag)] = flag
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                results[running.pop(future)] = future.result()
+
+    return [results[flag] for flag in flags]
@@ -0,0 +1,149 @@
+import logging
+import threading
+
+from prefix_filter import PrefixMatcher, Resource, iter_pages, matching_id
+
+
+# Flag -> (ResourceTypeFilters entry, "service:resource" prefixes of its
+# ARNs, whether the ID is what follows the prefix rather than the whole
+# ARN). Amplify apps are matched on their name and security groups on
+# their group name, neither of which the tagging API returns, so those
+# two are always listed per service.
+TAGGING_TYPES = {
+    'ecs': ('ecs:cluster', ('ecs:cluster/',), False),
+    'lambda': ('lambda:function', ('lambda:function:',), True),
+    'step': ('states:stateMachine', ('states:stateMachine:',), False),
+    'sns': ('sns', ('sns:',), False),
+    'ecr': ('ecr:repository', ('ecr:repository/',), True),
+    'elbv2': ('elasticloadbalancing:loadbalancer',
+              ('elasticloadbalancing:loadbalancer/app/',
+               'elasticloadbalancing:loadbalancer/net/',
+               'elasticloadbalancing:loadbalancer/gwy/'), False),
+    'tg': ('elasticloadbalancing:targetgroup',
+           ('elasticloadbalancing:targetgroup/',), False),
+    'ec2': ('ec2:instance', ('ec2:instance/',), True),
+    'elasticache': ('elasticache:cluster', ('elasticache:cluster:',), True),
+    'rds': ('rds:db', ('rds:db:',), True),
+    'redshift': ('redshift:cluster', ('redshift:cluster:',), True),
+    's3': ('s3', ('s3:',), True),
+    'vpc': ('ec2:vpc', ('ec2:vpc/',), True),
+}
+
+logger = logging.getLogger('aws_service_deleter')
+
+_settings = {'enabled': False, 'flags': ()}
+_lock = threading.Lock()
+_indexes = {}
+
+
+def configure(enabled=None, flags=None):
+    """Turn the tagging backend on or off and set the flags it lists for."""
+    if enabled is not None:
+        _settings['enabled'] = enabled
+    if flags is not None:
+        _settings['flags'] = tuple(flags)
+    with _lock:
+        _indexes.clear()
+
+
+def _route(arn, flags):
+    """Return (flag, resource ID) for an ARN, or None if no flag wants it."""
+    _, _, service, _, _, resource = arn.split(':', 5)
+    name = f"{service}:{resource}"
+    for flag in flags:
+        _, prefixes, strip = TAGGING_TYPES[flag]
+        for prefix in prefixes:
+            if name.startswith(prefix):
+                return flag, name[len(prefix):] if strip else arn
+    return None
+
+
+def _name_tag(tags):
+    for tag in tags:
+        if tag['Key'] == 'Name':
+            return tag['Value']
+    return None
+
+
+class _RegionIndex:
+    """The tagged resources of the selected types in one region that may
+    match a prefix, by flag.
+
+    Only resources whose ID or Name tag contains a prefix are kept, as
+    Resources named by their Name tag, so the index grows with the matches
+    rather than with the account; tagged() applies each service's exact
+    match.
+    """
+
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self._lock = threading.Lock()
+        self._by_flag = None
+
+    def resources(self, clients, flag):
+        with self._lock:
+            if self._by_flag is None:
+                self._by_flag = self._build(clients)
+        return self._by_flag.get(flag, [])
+
+    def _build(self, clients):
+        flags = [f for f in _settings['flags'] if f in TAGGING_TYPES]
+        type_filters = sorted({TAGGING_TYPES[f][0] for f in flags})
+        by_flag = {}
+        count = kept = 0
+        for page in iter_pages(clients.tagging, 'get_resources',
+                                 ResourceTypeFilters=type_filters):
+            for mapping in page.get('ResourceTagMappingList', []):
+                routed = _route(mapping['ResourceARN'], flags)
+                if routed is None:
+                    continue
+                count += 1
+                flag, resource_id = routed
+                name = _name_tag(mapping.get('Tags', []))
+                if not (self.matcher.mentions(resource_id)
+                        or (name is not None and self.matcher.mentions(name))):
+                    continue
+                by_flag.setdefault(flag, []).append(
+                    Resource(resource_id, flag, clients.region, name))
+                kept += 1
+        logger.info(
+            f"Found {count} tagged resources across {len(flags)} services "
+            f"in {clients.region}, {kept} of them candidates for {self.matcher}; "
+            f"untagged resources are only found with --discovery list")
+        return by_flag
+
+
+def _index(clients, matcher):
+    key = (clients.region, clients.credentials, str(matcher))
+    with _lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = _RegionIndex(matcher)
+    return index
+
+
+def tagged(clients, flag, prefix, identifier_key, service_type, discover):
+    """Yield the IDs of a service's matching resources.
+
+    With the tagging backend enabled, the first service to ask in a region
+    lists every selected resource type with one paginated get_resources
+    call, and all services of that region are answered from the result.
+    The usual prefix matching is applied, using the Name tag where the
+    listing APIs would. The tagging API only returns resources that carry
+    a tag, so untagged resources are not found; --discovery list finds
+    those. Otherwise, and for services the tagging API cannot match,
+    discover() lists the service directly.
+    """
+    if not _settings['enabled'] or flag not in TAGGING_TYPES:
+        yield from discover()
+        return
+
+    matcher = PrefixMatcher.of(prefix)
+    for resource in _index(clients, matcher).resources(clients, flag):
+        if service_type == 'ecs':
+            item = resource.id
+        else:
+            tags = [] if resource.name is None else [{'Key': 'Name', 'Value': resource.name}]
+            item = {identifier_key: resource.id, 'Tags': tags}
+        if matching_id(item, matcher, identifier_key, service_type) is not None:
+            yield resource.id
@@ -0,0 +1,228 @@
+import random
+import time
+
+from botocore.exceptions import WaiterError
+
+import deadline
+from aws_errors import is_not_found
+from batching import chunked
+from deadline import DeadlineReached
+from executor import DEFAULT_WORKERS, run_in_pool
+from logging_config import action_verb
+from prefix_filter import iter_pages
+from waiters import DEFAULT_BASE_DELAY, DEFAULT_MAX_DELAY
+
+
+# EC2 accepts at most 200 values in one filter.
+FILTER_VALUES_LIMIT = 200
+# Seconds to wait for NAT gateways and endpoints to release their subnets.
+CHILD_DELETE_TIMEOUT = 600
+
+# Child type -> (describe method, filter parameter name, VPC filter name,
+# result key). describe_nat_gateways spells its parameter "Filter".
+CHILD_TYPES = {
+    'nat_gateways': ('describe_nat_gateways', 'Filter', 'vpc-id', 'NatGateways'),
+    'vpc_endpoints': ('describe_vpc_endpoints', 'Filters', 'vpc-id', 'VpcEndpoints'),
+    'internet_gateways': ('describe_internet_gateways', 'Filters', 'attachment.vpc-id',
+                          'InternetGateways'),
+    'network_interfaces': ('describe_network_interfaces', 'Filters', 'vpc-id',
+                           'NetworkInterfaces'),
+    'subnets': ('describe_subnets', 'Filters', 'vpc-id', 'Subnets'),
+    'route_tables': ('describe_route_tables', 'Filters', 'vpc-id', 'RouteTables'),
+}
+
+
+def _vpc_ids_of(child_type, item):
+    if child_type == 'internet_gateways':
+        return [attachment['VpcId'] for attachment in item.get('Attachments', [])]
+    return [item['VpcId']]
+
+
+def _is_gone(item):
+    # Deleted NAT gateways and endpoints stay visible for a while.
+    return str(item.get('State', '')).lower() == 'deleted'
+
+
+def build_index(ec2, vpc_ids, workers=DEFAULT_WORKERS):
+    """Return {vpc_id: {child_type: [item, ...]}} for every VPC in vpc_ids.
+
+    Each child type is described with multi-value vpc-id filters covering
+    up to 200 VPCs per query rather than once per VPC, and the queries run
+    in parallel, so indexing 50 VPCs takes six calls instead of 200.
+    """
+    index = {vpc_id: {child_type: [] for child_type in CHILD_TYPES}
+             for vpc_id in vpc_ids}
+
+    def describe(query):
+        child_type, batch = query
+        method, param, filter_name, result_key = CHILD_TYPES[child_type]
+        pages = iter_pages(ec2, method, **{param: [{'Name': filter_name, 'Values': batch}]})
+        return [item for page in pages for item in page.get(result_key, [])]
+
+    queries = [(child_type, batch) for child_type in CHILD_TYPES
+               for batch in chunked(vpc_ids, FILTER_VALUES_LIMIT)]
+    for (child_type, _), items, error in run_in_pool(queries, describe, workers):
+        if error is not None:
+            raise error
+        for item in items:
+            if _is_gone(item):
+                continue
+            for vpc_id in _vpc_ids_of(child_type, item):
+                if vpc_id in index:
+                    index[vpc_id][child_type].append(item)
+    return index
+
+
+def _is_main(route_table):
+    return any(association.get('Main')
+               for association in route_table.get('Associations', []))
+
+
+def _wait_for_nat_gateways(ec2, nat_gateway_ids, timeout=CHILD_DELETE_TIMEOUT):
+    # The waiter polls every `delay` seconds; as many polls as fit in the
+    # time left, so it gives up by the run's deadline at the latest.
+    waiter = ec2.get_waiter('nat_gateway_deleted')
+    delay = waiter.config.delay
+    time_left = deadline.clamp(timeout)
+    attempts = max(1, int(time_left // delay))
+    try:
+        waiter.wait(NatGatewayIds=nat_gateway_ids,
+                    WaiterConfig={'Delay': delay, 'MaxAttempts': attempts})
+    except WaiterError:
+        if time_left < timeout:
+            raise DeadlineReached()
+        raise
+
+
+def _wait_for_endpoints(ec2, vpc_id, timeout=CHILD_DELETE_TIMEOUT):
+    delay = DEFAULT_BASE_DELAY
+    time_left = deadline.clamp(timeout)
+    gives_up_at = time.monotonic() + time_left
+    while True:
+        pages = iter_pages(ec2, 'describe_vpc_endpoints',
+                           Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])
+        if all(_is_gone(endpoint)
+               for page in pages for endpoint in page.get('VpcEndpoints', [])):
+            return
+        if time.monotonic() >= gives_up_at:
+            if time_left < timeout:
+                raise DeadlineReached()
+            raise TimeoutError(f"VPC endpoints in {vpc_id} are still being deleted")
+        time.sleep(min(random.uniform(delay / 2, delay),
+                       max(0.0, gives_up_at - time.monotonic())))
+        delay = min(DEFAULT_MAX_DELAY, delay * 2)
+
+
+def teardown_vpc(ec2, vpc_id, children, logger, is_execute=False):
+    """Delete one VPC's indexed children in dependency order, then the VPC.
+
+    NAT gateways and endpoints go first and are waited for, since their
+    network interfaces keep subnets in use; the waits end by the run's
+    deadline, raising DeadlineReached if it cut them short. Interfaces managed by AWS on
+    behalf of other services are left to disappear with their owners.
+    Children that are already gone are skipped.
+    """
+    def delete(verb, kind, resource_id, method, **kwargs):
+        logger.info(f"{action_verb(verb, is_execute)} {kind}: {resource_id}",
+                    extra={'service': kind, 'resource_id': resource_id, 'action': verb})
+        if not is_execute:
+            return
+        try:
+            getattr(ec2, method)(**kwargs)
+        except Exception as e:
+            if not is_not_found(e):
+                raise
+
+    logger.info(f"{action_verb('delete', is_execute)} resources in VPC: {vpc_id}")
+
+    nat_gateway_ids = [nat['NatGatewayId'] for nat in children['nat_gateways']]
+    for nat_gateway_id in nat_gateway_ids:
+        delete('delete', 'NAT gateway', nat_gateway_id,
+               'delete_nat_gateway', NatGatewayId=nat_gateway_id)
+
+    endpoint_ids = [endpoint['VpcEndpointId'] for endpoint in children['vpc_endpoints']]
+    if endpoint_ids:
+        logger.info(
+            f"{action_verb('delete', is_execute)} VPC endpoints: {', '.join(endpoint_ids)}")
+        if is_execute:
+            response = ec2.delete_vpc_endpoints(VpcEndpointIds=endpoint_ids)
+            for item in response.get('Unsuccessful', []):
+                logger.error(
+                    f"Failed to delete VPC endpoint: {item['ResourceId']} - "
+                    f"{item['Error']['Code']}: {item['Error']['Message']}")
+
+    if is_execute and nat_gateway_ids:
+        _wait_for_nat_gateways(ec2, nat_gateway_ids)
+    if is_execute and endpoint_ids:
+        _wait_for_endpoints(ec2, vpc_id)
+
+    for igw in children['internet_gateways']:
+        igw_id = igw['InternetGatewayId']
+        delete('detach', 'internet gateway', igw_id, 'detach_internet_gateway',
+               InternetGatewayId=igw_id, VpcId=vpc_id)
+        delete('delete', 'internet gateway', igw_id, 'delete_internet_gateway',
+               InternetGatewayId=igw_id)
+
+    for eni in children['network_interfaces']:
+        if eni.get('RequesterManaged'):
+            continue
+        eni_id = eni['NetworkInterfaceId']
+        delete('delete', 'network interface', eni_id,
+               'delete_network_interface', NetworkInterfaceId=eni_id)
+
+    for subnet in children['subnets']:
+        subnet_id = subnet['SubnetId']
+        delete('delete', 'subnet', subnet_id, 'delete_subnet', SubnetId=subnet_id)
+
+    for route_table in children['route_tables']:
+        if _is_main(route_table):
+            continue
+        rt_id = route_table['RouteTableId']
+        delete('delete', 'route table', rt_id, 'delete_route_table', RouteTableId=rt_id)
+
+    delete('delete', 'VPC', vpc_id, 'delete_vpc', VpcId=vpc_id)
+
+
+def teardown_vpcs(ec2, vpc_ids, logger, is_execute=False, workers=DEFAULT_WORKERS,
+                  track=None):
+    """Delete VPCs and everything in them, several VPCs at a time.
+
+    The children of all VPCs are found up front with build_index; in
+    execute mode each VPC is then torn down on its own pool thread, with
+    the outcome recorded in track (a journal.ServiceTracker) if given.
+    Returns (found, failed) VPC counts. VPCs not started, or cut short,
+    by the run's deadline are left untracked and reported by raising
+    DeadlineReached.
+    """
+    vpc_ids = list(vpc_ids)
+    if not vpc_ids:
+        return 0, 0
+    index = build_index(ec2, vpc_ids, workers)
+
+    if not is_execute:
+        for vpc_id in vpc_ids:
+            teardown_vpc(ec2, vpc_id, index[vpc_id], logger)
+        return len(vpc_ids), 0
+
+    def teardown(vpc_id):
+        deadline.check()
+        teardown_vpc(ec2, vpc_id, index[vpc_id], logger, True)
+
+    failed = undone = 0
+    for vpc_id, _, error in run_in_pool(vpc_ids, teardown, workers):
+        if error is None:
+            if track is not None:
+                track.issued(vpc_id)
+        elif isinstance(error, DeadlineReached):
+            undone += 1
+            logger.warning(f"Left VPC {vpc_id} undone at the deadline",
+                           extra={'service': 'VPC', 'resource_id': vpc_id,
+                                  'action': 'delete', 'outcome': 'undone'})
+        else:
+            failed += 1
+            if track is not None:
+                track.failed(vpc_id)
+            logger.error(f"Failed to delete VPC: {vpc_id} - {error}")
+    if undone:
+        raise DeadlineReached(len(vpc_ids), failed, undone)
+    return len(vpc_ids), failed
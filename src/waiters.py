@@ -0,0 +1,124 @@
+import random
+import threading
+import time
+
+
+DEFAULT_BASE_DELAY = 5
+DEFAULT_MAX_DELAY = 60
+
+
+class Watch:
+    """A group of in-flight deletions tracked by the WaiterEngine."""
+
+    def __init__(self, name, list_present, allowed, logger, base_delay, on_gone=None,
+                 expected=None):
+        self.name = name
+        self.on_gone = on_gone
+        self.list_present = list_present
+        self.allowed = allowed
+        self.logger = logger
+        self.delay = base_delay
+        self.next_poll = time.monotonic()
+        self.present = None if expected is None else set(expected)
+        self.done = threading.Event()
+
+
+class WaiterEngine:
+    """Polls many in-flight deletions from a single background thread.
+
+    Each watched group is polled with one listing call. Polls back off
+    exponentially with jitter, so slow deletions are not hammered and
+    groups do not poll in lockstep. Resources are reported as they
+    disappear, and a group is done once no more than `allowed` of its
+    resources are left.
+    """
+
+    def __init__(self, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._watches = []
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name='waiter-engine', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def track(self, name, list_present, logger, allowed=0, on_gone=None,
+              expected=None):
+        """Start watching a group; list_present() yields the IDs still there.
+
+        on_gone(resource_id) is called for each resource seen to disappear.
+        expected is the IDs being waited on; with it, those already gone
+        at the first poll are reported too.
+        """
+        watch = Watch(name, list_present, allowed, logger, self.base_delay, on_gone,
+                      expected)
+        with self._cond:
+            self._watches.append(watch)
+            self._cond.notify()
+        return watch
+
+    def wait(self, watch, timeout=None):
+        """Block until watch is done. Returns False on timeout."""
+        if watch.done.wait(timeout):
+            return True
+        with self._cond:
+            if watch in self._watches:
+                self._watches.remove(watch)
+        return watch.done.is_set()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and not self._watches:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                now = time.monotonic()
+                due = [w for w in self._watches if w.next_poll <= now]
+                if not due:
+                    self._cond.wait(
+                        min(w.next_poll for w in self._watches) - now)
+                    continue
+
+            for watch in due:
+                self._poll(watch)
+
+    def _poll(self, watch):
+        try:
+            present = set(watch.list_present())
+        except Exception as e:
+            watch.logger.warning(
+                f"Failed to check progress of {watch.name} deletions: {e}")
+            self._reschedule(watch)
+            return
+
+        if watch.present is not None:
+            for resource_id in sorted(watch.present - present):
+                watch.logger.info(
+                    f"Confirmed deleted {watch.name}: {resource_id}")
+                if watch.on_gone is not None:
+                    watch.on_gone(resource_id)
+        watch.present = present
+
+        if len(present) <= watch.allowed:
+            with self._cond:
+                if watch in self._watches:
+                    self._watches.remove(watch)
+            watch.done.set()
+        else:
+            self._reschedule(watch)
+
+    def _reschedule(self, watch):
+        watch.next_poll = time.monotonic() + random.uniform(
+            watch.delay / 2, watch.delay)
+        watch.delay = min(self.max_delay, watch.delay * 2)
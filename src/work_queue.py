@@ -0,0 +1,313 @@
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+
+DEFAULT_VISIBILITY_TIMEOUT = 300
+DEFAULT_MAX_ATTEMPTS = 3
+# Tasks per lease: small enough to spread work over workers, large
+# enough for batched deletes like EC2 terminations to pay off.
+DEFAULT_LEASE_SIZE = 50
+# Worker processes a coordinator starts on its own host.
+DEFAULT_LOCAL_WORKERS = 4
+# Seconds between checks of an idle worker or a waiting coordinator.
+POLL_INTERVAL = 2.0
+# Seconds SQLite waits for another process's write lock before giving up.
+BUSY_TIMEOUT = 60
+
+logger = logging.getLogger('aws_service_deleter')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    region TEXT NOT NULL,
+    flag TEXT NOT NULL,
+    resource_id TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'ready',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    lease_expires REAL,
+    error TEXT,
+    UNIQUE (region, flag, resource_id)
+);
+CREATE INDEX IF NOT EXISTS tasks_by_state ON tasks (state, lease_expires);
+"""
+
+
+class WorkQueueError(Exception):
+    """Raised for queues that belong to a different job."""
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """Durable queue of resources to delete, shared through a SQLite file.
+
+    A coordinator puts the resources it discovers; workers in any number
+    of processes lease batches of one region and service, delete them,
+    and ack or fail each one. A lease that is not acked within the
+    visibility timeout, e.g. because its worker crashed, expires and the
+    task is handed out again, up to max_attempts times. WAL mode lets
+    workers read while others write, but needs every process on one
+    host; shared=True uses SQLite's rollback journal instead, for queue
+    files on shared storage with working file locks.
+    """
+
+    def __init__(self, path, shared=False, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        # One connection per thread; the heartbeat thread has its own.
+        self._local = threading.local()
+        self._shared = shared
+        self._db().executescript(SCHEMA)
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT,
+                                 isolation_level=None)
+            if self._shared:
+                db.execute("PRAGMA journal_mode=DELETE")
+            else:
+                # In WAL mode a commit survives its process crashing even
+                # without a sync; a power cut can undo the last few acks,
+                # which only repeats deletions that are already done.
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _transaction(self):
+        return _Transaction(self._db())
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+    def get_meta(self, key):
+        row = self._db().execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row and row[0]
+
+    def set_meta(self, **values):
+        with self._transaction() as db:
+            db.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                           [(key, str(value)) for key, value in values.items()])
+
+    def start_job(self, prefix):
+        """Claim the queue for a job with prefix. A queue left by an
+        interrupted job with the same prefix is continued; tasks already
+        done stay done. After a finished job the queue starts over empty,
+        so resources recreated under the same names are deleted again."""
+        with self._transaction() as db:
+            row = db.execute("SELECT value FROM meta WHERE key = 'prefix'").fetchone()
+            if row and row[0] != prefix:
+                raise WorkQueueError(f"queue is for prefix '{row[0]}', not '{prefix}'")
+            finished = db.execute("SELECT value FROM meta WHERE key = 'finished'").fetchone()
+            if finished and finished[0] == '1':
+                db.execute("DELETE FROM tasks")
+            db.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                           [('prefix', prefix), ('finished', '0'), ('stopped', '0')])
+
+    def finish_job(self):
+        """Mark the job done; the next start_job starts over empty."""
+        self.set_meta(finished='1', stopped='1')
+
+    def stop_job(self):
+        """Tell workers to stop without finishing the job, e.g. after an
+        interrupt or the deadline, so the next start_job continues it."""
+        self.set_meta(stopped='1')
+
+    def is_stopped(self):
+        return self.get_meta('stopped') == '1'
+
+    def put(self, region, flag, resource_ids):
+        """Add tasks, skipping any the queue already has. Returns the IDs
+        that were added."""
+        added = []
+        with self._transaction() as db:
+            for resource_id in resource_ids:
+                cursor = db.execute(
+                    "INSERT OR IGNORE INTO tasks (region, flag, resource_id) VALUES (?, ?, ?)",
+                    (region, flag, resource_id))
+                if cursor.rowcount:
+                    added.append(resource_id)
+        return added
+
+    def lease(self, owner, limit=DEFAULT_LEASE_SIZE):
+        """Lease up to limit tasks of one region and service.
+
+        Returns (region, flag, {task_id: resource_id}), or None when no
+        task is ready. Tasks out of attempts are marked failed instead.
+        """
+        now = time.time()
+        leasable = "(state = 'ready' OR (state = 'leased' AND lease_expires < ?))"
+        with self._transaction() as db:
+            db.execute(
+                f"UPDATE tasks SET state = 'failed', owner = NULL, "
+                f"error = coalesce(error, 'lease expired') "
+                f"WHERE {leasable} AND attempts >= ?", (now, self.max_attempts))
+            row = db.execute(
+                f"SELECT region, flag FROM tasks WHERE {leasable} ORDER BY id LIMIT 1",
+                (now,)).fetchone()
+            if row is None:
+                return None
+            region, flag = row
+            tasks = dict(db.execute(
+                f"SELECT id, resource_id FROM tasks WHERE {leasable} "
+                f"AND region = ? AND flag = ? ORDER BY id LIMIT ?",
+                (now, region, flag, limit)).fetchall())
+            db.executemany(
+                "UPDATE tasks SET state = 'leased', owner = ?, lease_expires = ?, "
+                "attempts = attempts + 1 WHERE id = ?",
+                [(owner, now + self.visibility_timeout, task_id) for task_id in tasks])
+        return region, flag, tasks
+
+    def extend(self, owner, task_ids):
+        """Push back the expiry of leases owner still holds."""
+        with self._transaction() as db:
+            db.executemany(
+                "UPDATE tasks SET lease_expires = ? "
+                "WHERE id = ? AND state = 'leased' AND owner = ?",
+                [(time.time() + self.visibility_timeout, task_id, owner)
+                 for task_id in task_ids])
+
+    def ack(self, owner, task_id):
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE tasks SET state = 'done', owner = NULL, error = NULL "
+                "WHERE id = ? AND state = 'leased' AND owner = ?",
+                (task_id, owner))
+
+    def fail(self, owner, task_id, error, retry=True):
+        """Record a failed attempt; the task is handed out again while it
+        has attempts left and retry is set."""
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE tasks SET state = CASE WHEN ? AND attempts < ? "
+                "THEN 'ready' ELSE 'failed' END, owner = NULL, error = ? "
+                "WHERE id = ? AND state = 'leased' AND owner = ?",
+                (retry, self.max_attempts, error, task_id, owner))
+
+    def counts(self, region=None, flag=None):
+        """Return {state: count} for all tasks, or one region and service."""
+        query = "SELECT state, count(*) FROM tasks"
+        params = ()
+        if region is not None:
+            query += " WHERE region = ? AND flag = ?"
+            params = (region, flag)
+        rows = self._db().execute(query + " GROUP BY state", params).fetchall()
+        return dict(rows)
+
+    def wait_for(self, region, flag, poll_interval=POLL_INTERVAL, timeout=None):
+        """Block until every task of a region and service is done or failed,
+        or for at most timeout seconds, and return its counts."""
+        give_up_at = None if timeout is None else time.monotonic() + timeout
+        while True:
+            counts = self.counts(region, flag)
+            if not counts.get('ready') and not counts.get('leased'):
+                return counts
+            delay = poll_interval
+            if give_up_at is not None:
+                left = give_up_at - time.monotonic()
+                if left <= 0:
+                    return counts
+                delay = min(delay, left)
+            time.sleep(delay)
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, rolled back on errors. Taking the write
+    lock up front keeps two workers from leasing the same task."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, *exc_info):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+class LeasedBatch:
+    """One leased batch, standing in for the journal while a worker runs a
+    service's delete handler on it (see journal.configure).
+
+    The handler gets the leased IDs instead of discovering, and its
+    outcomes ack (issued, confirmed) or fail the tasks. While the handler
+    runs, a heartbeat keeps the remaining leases from expiring.
+    """
+
+    def __init__(self, queue, owner, tasks):
+        self.queue = queue
+        self.owner = owner
+        self._task_ids = {resource_id: task_id for task_id, resource_id in tasks.items()}
+        self._open = set(tasks)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._heartbeat, name='work-queue-heartbeat', daemon=True)
+        self.done = self.failed = 0
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stopped.set()
+        self._thread.join()
+        # Tasks the handler never got to, e.g. because it raised, are
+        # handed out again.
+        error = str(exc) if exc else "not attempted"
+        for task_id in self._take_open():
+            self.queue.fail(self.owner, task_id, error)
+            self.failed += 1
+
+    def _take_open(self):
+        with self._lock:
+            task_ids, self._open = self._open, set()
+        return task_ids
+
+    def _heartbeat(self):
+        interval = self.queue.visibility_timeout / 3
+        while not self._stopped.wait(interval):
+            with self._lock:
+                task_ids = list(self._open)
+            try:
+                self.queue.extend(self.owner, task_ids)
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to extend work queue leases: {e}")
+        self.queue.close()
+
+    def resources(self, region, flag, discover):
+        return list(self._task_ids)
+
+    def record(self, region, flag, state, resource_id=None):
+        task_id = self._task_ids.get(resource_id)
+        if task_id is None or state == 'discovered':
+            return
+        with self._lock:
+            if task_id not in self._open:
+                return
+            self._open.discard(task_id)
+        if state in ('issued', 'confirmed'):
+            self.queue.ack(self.owner, task_id)
+            self.done += 1
+        else:
+            self.queue.fail(self.owner, task_id, f"{flag} delete failed")
+            self.failed += 1